@@ -1,8 +1,9 @@
-from channels import Channel
 from django.contrib import admin
+from django.db import transaction
 
+from app import simulation, writebehind
 from app.models import FlightStatus
-from .models import Facility, Weather, MapSession, Flight
+from .models import Facility, Weather, MapSession, Flight, PositionReport
 
 
 @admin.register(Facility)
@@ -15,23 +16,38 @@ class FlightAdmin(admin.ModelAdmin):
     list_display = ['ident', 'status', 'current_step', 'departure_facility', 'arrival_facility']
     actions = ['simulate', 'reset']
 
+    def get_object(self, request, object_id, from_field=None):
+        # Edit the flight as last simulated, not as last flushed
+        flight = super(FlightAdmin, self).get_object(request, object_id, from_field)
+        return writebehind.overlay([flight])[0] if flight else None
+
     def simulate(self, request, queryset):
-        for flight in queryset:
-            Channel('flightplan.simulate').send({'pk': flight.pk})
+        simulation.activate(writebehind.overlay(list(queryset)))
 
     simulate.short_description = "Simulate Selected Flights"
 
     def reset(self, request, queryset):
-        for flight in queryset:
-            flight.status = FlightStatus.FILED.value
-            flight.location = None
-            flight.heading = None
-            flight.current_step = 0
-            flight.save()
+        for flight in writebehind.overlay(list(queryset)):
+            with transaction.atomic():
+                # Let a flush writing the flight finish; later ones skip it
+                writebehind.lock([flight.pk])
+                writebehind.forget([flight.pk])
+                flight.status = FlightStatus.FILED.value
+                flight.location = None
+                flight.heading = None
+                flight.current_step = 0
+                flight.position_reports.all().delete()
+                flight.save()
 
     reset.short_description = "Reset Selected Flights"
 
 
+@admin.register(PositionReport)
+class PositionReportAdmin(admin.ModelAdmin):
+    list_display = ['flight', 'time', 'heading']
+    list_filter = ['flight']
+
+
 @admin.register(Weather)
 class WeatherAdmin(admin.ModelAdmin):
     pass
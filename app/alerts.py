@@ -0,0 +1,99 @@
+"""
+Weather-in-path alerts.
+
+Flights whose remaining path crosses a weather cell are found from the live
+flight state, without querying the database. Each (flight, weather)
+pair is alerted once: the pairs already alerted are remembered in Redis
+until the weather is deleted or ALERT_TTL passes. Each process also
+remembers the pairs it has seen alerted, so a flight that stays in the
+path of weather tick after tick costs no Redis round trip.
+"""
+import json
+import time
+
+from channels.generic.websockets import WebsocketDemultiplexer
+from django.conf import settings
+
+from app import live, webhooks
+from app.models import FlightStatus, MapSession
+from app.store import get_redis
+
+ALERTED_KEY = 'alerts:weather:{weather}'
+ALERT_TTL = 24 * 60 * 60
+
+STREAM = 'aircraft.alert'
+
+# (weather_pk, flight_pk) pairs known to be alerted, and until when
+_known = {}
+
+
+def payload(flight):
+    """
+    flight is a Flight or a live.LiveFlight.
+    """
+    point = flight.remaining_path.interpolate_normalized(0.5)
+    responsible = flight.responsible
+    return {
+        'acid': flight.ident,
+        'responsible': responsible.ident if responsible else None,
+        'alert': 'Weather in flight path',
+        'url': '{url}/#{zoom}/{point.y}/{point.x}'.format(url=settings.BASE_URL, zoom=6, point=point)
+    }
+
+
+def unalerted(pairs):
+    """
+    The (flight, weather_pk) pairs that have not been alerted yet, marking
+    them as alerted.
+    """
+    now = time.time()
+    pairs = [(flight, weather_pk) for flight, weather_pk in pairs if _known.get((weather_pk, flight.pk), 0) <= now]
+    if not pairs:
+        return []
+
+    redis = get_redis()
+    pipe = redis.pipeline(transaction=False)
+    for flight, weather_pk in pairs:
+        pipe.sadd(ALERTED_KEY.format(weather=weather_pk), flight.pk)
+    added = pipe.execute()
+
+    if len(_known) > 100000:
+        for pair in [pair for pair, until in _known.items() if until <= now]:
+            del _known[pair]
+    # The Redis set outlives these: its expiry is pushed back on every new alert
+    _known.update(((weather_pk, flight.pk), now + ALERT_TTL) for flight, weather_pk in pairs)
+
+    new_pairs = [pair for pair, new in zip(pairs, added) if new]
+    pipe = redis.pipeline(transaction=False)
+    for weather_pk in {weather_pk for flight, weather_pk in new_pairs}:
+        pipe.expire(ALERTED_KEY.format(weather=weather_pk), ALERT_TTL)
+    pipe.execute()
+    return new_pairs
+
+
+def alert(pairs):
+    """
+    Send the alerts for (flight, weather_pk) pairs, skipping repeats.
+    """
+    for flight, weather_pk in unalerted(pairs):
+        data = payload(flight)
+        if settings.SEND_POSTS:
+            webhooks.post(settings.WEATHER_ALERT_POST_URL, json.dumps(data))
+
+        if flight.status == FlightStatus.ACTIVE.value:
+            MapSession.send_for_geometry(WebsocketDemultiplexer.encode(STREAM, data), flight.location)
+
+
+def weather_changed(weather):
+    prepared = weather.geom.prepared
+    flights = [
+        flight for flight in live.flights_crossing(weather.geom.extent)
+        if flight.status != FlightStatus.CLOSED.value and prepared.intersects(flight.remaining_path)
+    ]
+    alert([(flight, weather.pk) for flight in flights])
+
+
+def weather_deleted(weather):
+    get_redis().delete(ALERTED_KEY.format(weather=weather.pk))
+    for pair in [pair for pair in _known if pair[0] == weather.pk]:
+        del _known[pair]
@@ -0,0 +1,284 @@
+"""
+Load test harness for the channels pipeline.
+
+The default channel layer is swapped for an in-memory one and consumers are
+run in-process, against the configured PostGIS database and a separate Redis
+database. Facilities are seeded with the factories, flight plans are filed
+through the /flightplan websocket stream, map clients connect to /app/map
+and move to random viewports, and the simulation is then advanced tick by
+tick while the delay from tick start to each position report reaching a
+client channel is recorded.
+
+The Redis database is flushed before and after a run, so the harness
+refuses to run against any database but BENCHMARK_REDIS_DB. Only the
+facilities, flights and sessions the run created are deleted afterwards.
+A run fails when the p99 tick or delivery time exceeds its threshold.
+"""
+import datetime
+import json
+import random
+import time
+
+from asgiref.inmemory import ChannelLayer as InMemoryChannelLayer
+from channels import DEFAULT_CHANNEL_LAYER
+from channels.asgi import ChannelLayerWrapper, channel_layers
+from channels.message import Message
+
+from app import scheduler, simulation, store
+from app.factories import FuzzyPoint, create_facilities
+from app.models import Facility, Flight, MapSession
+
+FACILITY_PREFIX = 'Z'
+FLIGHT_PREFIX = 'BENCH'
+
+BENCHMARK_REDIS_DB = 15
+
+# Default pass/fail thresholds, in milliseconds
+MAX_TICK_P99_MS = 1000
+MAX_DELIVERY_P99_MS = 1000
+
+# Channels that are driven by the harness itself rather than by the pump
+UNPUMPED = {simulation.TICK_CHANNEL}
+
+
+class TimedChannelLayer(InMemoryChannelLayer):
+    """
+    In-memory layer that stamps every message with the time it was sent.
+    """
+
+    def send(self, channel, message):
+        super(TimedChannelLayer, self).send(channel, dict(message, sent_at=time.time()))
+
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+
+class Client(object):
+    """
+    A simulated websocket client on path.
+    """
+
+    def __init__(self, layer, path, name):
+        self.layer = layer
+        self.path = path
+        self.reply_channel = 'benchmark.send!{}'.format(name)
+        self.order = 0
+
+    def connect(self):
+        self.layer.send('websocket.connect', {'reply_channel': self.reply_channel, 'path': self.path, 'order': 0})
+
+    def disconnect(self):
+        self.layer.send('websocket.disconnect', {'reply_channel': self.reply_channel, 'path': self.path, 'code': 1000})
+
+    def send(self, stream, payload):
+        self.order += 1
+        self.layer.send('websocket.receive', {
+            'reply_channel': self.reply_channel,
+            'path': self.path,
+            'order': self.order,
+            'text': json.dumps({'stream': stream, 'payload': payload}),
+        })
+
+    def receive_all(self):
+        """
+        (received_at, sent_at, stream, size) of every message waiting for the client.
+        """
+        messages = []
+        while True:
+            channel, content = self.layer.receive([self.reply_channel])
+            if channel is None:
+                return messages
+            text = content.get('text', '')
+            stream = json.loads(text).get('stream') if text else None
+            messages.append((time.time(), content['sent_at'], stream, len(text)))
+
+
+class Harness(object):
+
+    def __init__(self, facilities=50, flights=1000, sessions=20, report_seconds=10, ticks=10, seed='benchmark',
+                 max_tick_ms=MAX_TICK_P99_MS, max_delivery_ms=MAX_DELIVERY_P99_MS):
+        self.facility_count = facilities
+        self.flight_count = flights
+        self.session_count = sessions
+        self.report_seconds = report_seconds
+        self.ticks = ticks
+        self.random = random.Random(seed)
+        self.thresholds = {'tick_p99_ms': max_tick_ms, 'delivery_p99_ms': max_delivery_ms}
+        self.layer = None
+        self.results = {}
+        self.facilities = []
+        self.flight_idents = []
+
+    def flush_redis(self):
+        redis = store.get_redis()
+        db = redis.connection_pool.connection_kwargs.get('db')
+        if db != BENCHMARK_REDIS_DB:
+            raise ValueError('Refusing to flush Redis database {}, the benchmark uses {}'.format(db, BENCHMARK_REDIS_DB))
+        redis.flushdb()
+
+    def install(self):
+        """
+        Route the default channel layer through an in-memory layer.
+        """
+        self.layer = ChannelLayerWrapper(
+            TimedChannelLayer(capacity=10 ** 7),
+            DEFAULT_CHANNEL_LAYER,
+            channel_layers[DEFAULT_CHANNEL_LAYER].routing[:],
+        )
+        store._client = None
+        self.flush_redis()
+        self._old_layer = channel_layers.set(DEFAULT_CHANNEL_LAYER, self.layer)
+
+    def uninstall(self):
+        channel_layers.set(DEFAULT_CHANNEL_LAYER, self._old_layer)
+        store._client = None
+
+    def pump(self, timeout=5.0):
+        """
+        Run scheduled messages and consumers until the layer is idle.
+        """
+        channels = [c for c in self.layer.router.channels if c not in UNPUMPED]
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            scheduler.dispatch()
+            channel, content = self.layer.receive(channels)
+            if channel is None:
+                upcoming = scheduler.next_due()
+                if upcoming is None or upcoming > deadline:
+                    return
+                time.sleep(0.01)
+                continue
+            message = Message(content, channel, self.layer)
+            match = self.layer.router.match(message)
+            if match:
+                consumer, kwargs = match
+                consumer(message, **kwargs)
+
+    def seed(self):
+        """
+        Create facilities, with idents no existing facility has.
+        """
+        candidates = ['{}{:04d}'.format(FACILITY_PREFIX, i) for i in range(10 ** 4)]
+        taken = set(Facility.objects.filter(ident__startswith=FACILITY_PREFIX).values_list('ident', flat=True))
+        idents = [ident for ident in candidates if ident not in taken][:self.facility_count]
+        area = FuzzyPoint(min_x=-125, max_x=-65, min_y=25, max_y=55)
+        self.facilities = create_facilities(len(idents), idents=idents, location=area)
+
+    def viewport(self):
+        x = self.random.uniform(-125, -75)
+        y = self.random.uniform(25, 45)
+        zoom = self.random.choice([5, 6, 7, 8, 9])
+        span = 360.0 / 2 ** zoom * 2
+        return [x, y, x + span, y + span / 2], zoom
+
+    def connect_maps(self):
+        self.maps = [Client(self.layer, '/app/map', 'map{}'.format(i)) for i in range(self.session_count)]
+        for client in self.maps:
+            client.connect()
+            bounds, zoom = self.viewport()
+            client.send('map.move', {'bounds': bounds, 'zoom': zoom})
+        started = time.time()
+        self.pump()
+        self.results['initial_sync_seconds'] = time.time() - started
+        self.results['initial_sync_bytes'] = sum(m[3] for c in self.maps for m in c.receive_all())
+
+    def file_plans(self, batch_size=500):
+        planner = Client(self.layer, '/flightplan', 'planner')
+        planner.connect()
+        etd = datetime.datetime.utcnow().isoformat() + 'Z'
+        plans = []
+        taken = set(Flight.objects.filter(ident__startswith=FLIGHT_PREFIX).values_list('ident', flat=True))
+        for i in range(self.flight_count):
+            ident = '{}{:06d}'.format(FLIGHT_PREFIX, i)
+            if ident in taken:
+                continue
+            departure, arrival = self.random.sample(self.facilities, 2)
+            plans.append({
+                'acid': ident,
+                'departure': departure.ident,
+                'destination': arrival.ident,
+                'etd': etd,
+                'total_eet': self.report_seconds * (self.ticks + 10),
+                'state': 'active',
+            })
+
+        self.flight_idents = [plan['acid'] for plan in plans]
+
+        started = time.time()
+        for i in range(0, len(plans), batch_size):
+            planner.send('flightplan.batch', {'plans': plans[i:i + batch_size]})
+        self.pump()
+        elapsed = time.time() - started
+        self.results['ingest_seconds'] = elapsed
+        self.results['ingest_plans_per_second'] = len(plans) / elapsed if elapsed else 0
+        for client in self.maps:
+            client.receive_all()
+
+    def run_ticks(self):
+        latencies = []
+        tick_seconds = []
+        reports = 0
+        delivered_bytes = 0
+        timestamp = simulation.now()
+
+        for _ in range(self.ticks):
+            timestamp += datetime.timedelta(seconds=self.report_seconds)
+            started = time.time()
+            reports += len(simulation.advance(self.report_seconds, timestamp))
+            self.pump()
+            tick_seconds.append(time.time() - started)
+
+            for client in self.maps:
+                for received_at, sent_at, stream, size in client.receive_all():
+                    delivered_bytes += size
+                    if stream == 'flight.info':
+                        latencies.append(sent_at - started)
+
+        total = sum(tick_seconds)
+        self.results.update({
+            'position_reports': reports,
+            'reports_per_second': reports / total if total else 0,
+            'deliveries': len(latencies),
+            'delivered_bytes': delivered_bytes,
+            'tick_p50_ms': percentile(tick_seconds, 50) * 1000,
+            'tick_p99_ms': percentile(tick_seconds, 99) * 1000,
+            'delivery_p50_ms': percentile(latencies, 50) * 1000,
+            'delivery_p99_ms': percentile(latencies, 99) * 1000,
+        })
+
+    def cleanup(self):
+        for client in getattr(self, 'maps', []):
+            client.disconnect()
+        self.pump()
+        MapSession.objects.filter(channel__startswith='benchmark.').delete()
+        for i in range(0, len(self.flight_idents), 1000):
+            Flight.objects.filter(ident__in=self.flight_idents[i:i + 1000]).delete()
+        Facility.objects.filter(pk__in=[facility.pk for facility in self.facilities]).delete()
+        self.flush_redis()
+
+    def failures(self):
+        """
+        Descriptions of the results over their threshold.
+        """
+        return [
+            '{} {:.2f} exceeds {:.2f}'.format(name, self.results[name], limit)
+            for name, limit in sorted(self.thresholds.items())
+            if limit is not None and self.results.get(name, 0) > limit
+        ]
+
+    def run(self, keep=False):
+        self.install()
+        try:
+            self.seed()
+            self.connect_maps()
+            self.file_plans()
+            self.run_ticks()
+        finally:
+            if not keep:
+                self.cleanup()
+            self.uninstall()
+        return self.results
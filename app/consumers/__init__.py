@@ -1,7 +1,26 @@
 from channels.generic.websockets import WebsocketDemultiplexer
 
+from app import lanes
 
-class DefaultDemultiplexer(WebsocketDemultiplexer):
+
+class LaneDemultiplexer(WebsocketDemultiplexer):
+    """
+    Records the handling time of websocket messages in their lane, and
+    stamps forwarded payloads with the time they were queued, for the
+    per-lane latency metrics.
+    """
+
+    def dispatch(self, message, **kwargs):
+        with lanes.handling(message.channel.name):
+            return super(LaneDemultiplexer, self).dispatch(message, **kwargs)
+
+    def receive(self, content, **kwargs):
+        if isinstance(content, dict) and isinstance(content.get('payload'), dict):
+            lanes.stamp(content['payload'])
+        super(LaneDemultiplexer, self).receive(content, **kwargs)
+
+
+class DefaultDemultiplexer(LaneDemultiplexer):
     mapping = {}
 
     def connection_groups(self, *args, **kwargs):
@@ -1,22 +1,65 @@
 from channels.auth import channel_session_user
-from channels.generic.websockets import WebsocketDemultiplexer
 
+from app import liveness, metrics
+from app import sync as viewport_sync
+from app.consumers import LaneDemultiplexer
 from app.gis import bounding_box_to_polygon
 from app.models import MapSession
 
 
-class Demultiplexer(WebsocketDemultiplexer):
+class Demultiplexer(LaneDemultiplexer):
     mapping = {
         "map.move": "map.move",
+        "map.heartbeat": "map.heartbeat",
     }
 
     def connection_groups(self, *args, **kwargs):
         return ["map"]
 
+    def connect(self, message, **kwargs):
+        super(Demultiplexer, self).connect(message, **kwargs)
+        liveness.connected(message.reply_channel.name)
 
+    def disconnect(self, message, **kwargs):
+        liveness.evict([message.reply_channel.name])
+
+
+@metrics.timed('consumer.map.move')
 @channel_session_user
 def move(message):
-    MapSession.objects.update_or_create(channel=message.reply_channel.name, defaults={
-        'zoom': message.content['zoom'],
-        'bounds': bounding_box_to_polygon(message.content['bounds']),
+    liveness.touch(message.reply_channel.name)
+    viewport_sync.queue_move(
+        message.reply_channel.name,
+        message.content['bounds'],
+        message.content['zoom'],
+        message.content.get('format') == 'compact',
+    )
+
+
+@metrics.timed('consumer.map.sync')
+def sync(message):
+    """
+    Apply the latest move of a session, unless a newer one is queued.
+    """
+    channel = message.content['channel']
+    move = viewport_sync.take_move(channel, message.content['seq'])
+    if move is None:
+        metrics.incr('map.sync.superseded')
+        return
+    if not liveness.is_alive(channel):
+        return
+
+    MapSession.objects.update_or_create(channel=channel, defaults={
+        'zoom': move['zoom'],
+        'bounds': bounding_box_to_polygon(move['bounds']),
+        'compact': move.get('compact', False),
     })
+
+
+def heartbeat(message):
+    liveness.touch(message.reply_channel.name)
+
+
+@metrics.timed('consumer.map.reap')
+def reap(message):
+    liveness.run_reaper()
@@ -8,7 +8,7 @@ from django.contrib.gis.geos import Point
 from django.utils.timezone import UTC
 from factory.fuzzy import FuzzyText, FuzzyDateTime, FuzzyInteger
 
-from app.gis import buffer_geometry
+from app.gis import buffer_geometry, buffer_geometries
 from .models import FlightStatus, Facility
 
 
@@ -28,6 +28,9 @@ class FuzzyPoint(factory.fuzzy.BaseFuzzyAttribute):
         return Point(random.uniform(self.min_x, self.max_x), random.uniform(self.min_y, self.max_y))
 
 
+facility_location = FuzzyPoint(min_x=-80, max_x=-70, min_y=40, max_y=50)
+
+
 class FacilityFactory(factory.django.DjangoModelFactory):
     class Meta:
         model = 'app.Facility'
@@ -35,7 +38,7 @@ class FacilityFactory(factory.django.DjangoModelFactory):
 
     name = factory.Faker('city')
     ident = FuzzyText(prefix='C', chars=string.ascii_uppercase, length=3)
-    location = FuzzyPoint(min_x=-80, max_x=-70, min_y=40, max_y=50)
+    location = facility_location
 
     @factory.post_generation
     def responsibility(self, create, extracted, **kwargs):
@@ -45,6 +48,19 @@ class FacilityFactory(factory.django.DjangoModelFactory):
             self.responsibility = buffer_geometry(self.location, 30)
 
 
+def create_facilities(size, extent_in_nm=30, idents=None, location=facility_location, **kwargs):
+    """
+    Create size facilities, buffering all of their responsibility areas in one pass.
+    """
+    locations = [location.fuzz() for _ in range(size)]
+    areas = buffer_geometries(locations, extent_in_nm)
+    if idents is not None:
+        kwargs_list = [dict(kwargs, ident=ident) for ident in idents]
+    else:
+        kwargs_list = [kwargs] * size
+    return [FacilityFactory(location=l, responsibility=a, **kw) for l, a, kw in zip(locations, areas, kwargs_list)]
+
+
 class FlightFactory(factory.django.DjangoModelFactory):
     class Meta:
         model = 'app.Flight'
@@ -0,0 +1,73 @@
+"""
+GeoJSON serialization helpers.
+
+Geometries are converted straight from their coordinates instead of going
+through GEOS' JSON output, and serialized payloads are cached so one
+object is encoded once no matter how many sessions or hooks receive it.
+"""
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from app.store import get_redis
+
+CACHE_KEY = 'geojson:{name}:{variant}:{pk}'
+
+
+def geometry(geom):
+    """
+    GeoJSON geometry dict for a GEOS geometry, or None.
+    """
+    if geom is None:
+        return None
+    return {'type': geom.geom_type, 'coordinates': geom.coords}
+
+
+def dumps(payload):
+    return json.dumps(payload, cls=DjangoJSONEncoder)
+
+
+def encode(stream, text):
+    """
+    Same as WebsocketDemultiplexer.encode, for a payload that is already
+    serialized.
+    """
+    return {'text': '{"stream": %s, "payload": %s}' % (json.dumps(stream), text)}
+
+
+class GeoJSONCache(object):
+    """
+    Serialized geojson(variant) output of rarely changing objects, shared
+    between processes through Redis. All variants of an object are dropped
+    with invalidate() when it is saved or deleted.
+    """
+
+    def __init__(self, name, variants):
+        self.name = name
+        self.variants = variants
+
+    def key(self, pk, variant):
+        return CACHE_KEY.format(name=self.name, variant=variant, pk=pk)
+
+    def get_many(self, objects, variant):
+        objects = list(objects)
+        if not objects:
+            return []
+        redis = get_redis()
+        texts = redis.mget([self.key(o.pk, variant) for o in objects])
+
+        pipe = redis.pipeline()
+        for i, (obj, text) in enumerate(zip(objects, texts)):
+            if text is None:
+                texts[i] = dumps(obj.geojson(variant))
+                pipe.set(self.key(obj.pk, variant), texts[i])
+            else:
+                texts[i] = text.decode('utf-8')
+        pipe.execute()
+        return texts
+
+    def text(self, obj, variant):
+        return self.get_many([obj], variant)[0]
+
+    def invalidate(self, pk):
+        get_redis().delete(*[self.key(pk, variant) for variant in self.variants])
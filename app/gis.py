@@ -1,7 +1,9 @@
-import math
+from collections import OrderedDict
 
+import numpy as np
 from django.contrib.gis.gdal import CoordTransform
 from django.contrib.gis.gdal import SpatialReference
+from django.contrib.gis.geos import GeometryCollection
 from django.contrib.gis.geos import MultiPolygon
 from django.contrib.gis.geos import Polygon
 from django.contrib.gis.measure import Distance
@@ -13,49 +15,35 @@ def bounding_box_to_polygon(bbox):
     return Polygon(points)
 
 
-def compass_bearing(pointA, pointB):
-    """
-    Calculates the bearing between two points.
-    The formulae used is the following:
-        θ = atan2(sin(Δlong).cos(lat2),
-                  cos(lat1).sin(lat2) − sin(lat1).cos(lat2).cos(Δlong))
-    :Parameters:
-      - `pointA: The tuple representing the latitude/longitude for the
-        first point. Latitude and longitude must be in decimal degrees
-      - `pointB: The tuple representing the latitude/longitude for the
-        second point. Latitude and longitude must be in decimal degrees
-    :Returns:
-      The bearing in degrees
-    :Returns Type:
-      float
-    """
-
-    lat1 = math.radians(pointA.y)
-    lat2 = math.radians(pointB.y)
-
-    diffLong = math.radians(pointB.x - pointA.x)
+PROJ_7314 = SpatialReference(
+    'PROJCS["NA Lambert Azimuthal Equal Area",GEOGCS["GCS_WGS_1984",DATUM["D_WGS_1984",SPHEROID["WGS_1984",6378137.0,298.257223563]],PRIMEM["Greenwich",0.0],UNIT["degree",0.0174532925199433]],PROJECTION["Lambert_Azimuthal_Equal_Area"],PARAMETER["false_easting",0.0],PARAMETER["false_northing",0.0],PARAMETER["longitude_of_center",-100.0],PARAMETER["latitude_of_center",45.0],UNIT["meter",1.0]]')
+PROJ_4326 = SpatialReference('EPSG:4326')
 
-    x = math.sin(diffLong) * math.cos(lat2)
-    y = math.cos(lat1) * math.sin(lat2) - (math.sin(lat1)
-                                           * math.cos(lat2) * math.cos(diffLong))
+PROJ_4326_TO_7314 = CoordTransform(PROJ_4326, PROJ_7314)
+PROJ_7314_TO_4326 = CoordTransform(PROJ_7314, PROJ_4326)
 
-    initial_bearing = math.atan2(x, y)
 
-    # Now we have the initial bearing but math.atan2 return values
-    # from -180° to + 180° which is not what we want for a compass bearing
-    # The solution is to normalize the initial bearing as shown below
-    initial_bearing = math.degrees(initial_bearing)
-    compass_bearing = (initial_bearing + 360) % 360
+def unwrap_direction(longitudes):
+    """
+    Given an array of longitudes from one ring, returns -1 or 1 if the ring crosses the
+    anti-meridian and its longitudes should all be made negative or positive, or 0 if it doesn't.
 
-    return compass_bearing
+    The ring is assumed to go around the world the shortest possible way, defaulting to the prime
+    meridian if it spans exactly half of the globe.
+    """
+    # If the sum total of the minimum and maximum longitudes is greater than 180, we're wrapping
+    # around the anti-meridian; otherwise, we can just leave the longitudes alone
+    if abs(longitudes.min()) + abs(longitudes.max()) <= 180:
+        return 0
 
+    # The sign is decided by the side of the anti-meridian with the smallest absolute longitude
+    return -1 if longitudes[np.abs(longitudes).argmin()] < 0 else 1
 
-PROJ_7314 = SpatialReference(
-    'PROJCS["NA Lambert Azimuthal Equal Area",GEOGCS["GCS_WGS_1984",DATUM["D_WGS_1984",SPHEROID["WGS_1984",6378137.0,298.257223563]],PRIMEM["Greenwich",0.0],UNIT["degree",0.0174532925199433]],PROJECTION["Lambert_Azimuthal_Equal_Area"],PARAMETER["false_easting",0.0],PARAMETER["false_northing",0.0],PARAMETER["longitude_of_center",-100.0],PARAMETER["latitude_of_center",45.0],UNIT["meter",1.0]]')
-PROJ_4326 = SpatialReference('EPSG:4326')
 
-PROJ_4326_TO_7314 = CoordTransform(PROJ_4326, PROJ_7314)
-PROJ_7314_TO_4326 = CoordTransform(PROJ_7314, PROJ_4326)
+def unwrap_longitudes(longitudes, direction):
+    if direction < 0:
+        return np.where(longitudes > 0, longitudes - 360, longitudes)
+    return np.where(longitudes < 0, longitudes + 360, longitudes)
 
 
 def unwrap_polygon(polygon):
@@ -67,39 +55,16 @@ def unwrap_polygon(polygon):
     so that a polygon is now represented as (160 45), (200 45), (200, 55), (160, 55), (160 45)
     instead of (160 45), (-160 45), (-160, 55), (160, 55), (160 45)
 
-    This function assumes that we always want to wrap the polygon around the world the shortest
-    possible way, defaulting to wrapping around the prime meridian if the polygon wraps around
-    exactly half of the globe
+    The decision is made on the exterior ring and applied to any holes as well.
     """
-    # Get all the longitudes from the passed-in coordinates
-    longitudes = [c[0] for c in polygon.coords[0]]
-    # If the sum total of the minimum and maximum longitudes is greater than 180, we're wrapping
-    # around the anti-meridian; otherwise, we can just leave the polygon alone (if it happens to be
-    # *exactly* halfway around the globe, we default to wrapping around the *prime* meridian)
-    if (abs(min(longitudes)) + abs(max(longitudes))) <= 180:
+    rings = [np.array(ring) for ring in polygon.coords]
+    direction = unwrap_direction(rings[0][:, 0])
+    if not direction:
         return polygon
 
-    # We have to figure out if the resulting longitude should be positive or negative; we decide
-    # that based on which side of the polygon is "larger" (has the smallest longitude) after
-    # splitting it on the anti-meridian
-    smallest_longitude = min(longitudes, key=lambda value: abs(value))
-
-    # Use that point to determine what sign we use for longitudes
-    is_negative_lng = True if smallest_longitude < 0 else False
-    unwrapped_coords = []
-
-    for point in polygon.coords[0]:
-        lng = point[0]
-        lat = point[1]
-
-        if is_negative_lng and lng > 0:
-            unwrapped_coords.append((lng - 360, lat))
-        elif not is_negative_lng and lng < 0:
-            unwrapped_coords.append((lng + 360, lat))
-        else:
-            unwrapped_coords.append(point)
-
-    return Polygon(unwrapped_coords)
+    for ring in rings:
+        ring[:, 0] = unwrap_longitudes(ring[:, 0], direction)
+    return Polygon(*[ring.tolist() for ring in rings])
 
 
 def unwrap_multipolygon(multipolygon):
@@ -112,6 +77,67 @@ def unwrap_multipolygon(multipolygon):
     return multipolygon
 
 
+class GeometryCache(object):
+    """
+    Small LRU cache of geometries. Clones are stored and returned, since
+    GEOS geometries are mutable.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        geometry = self.entries.get(key)
+        if geometry is None:
+            return None
+        self.entries.move_to_end(key)
+        return geometry.clone()
+
+    def set(self, key, geometry):
+        self.entries[key] = geometry.clone()
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+
+buffer_cache = GeometryCache()
+
+
+def buffer_key(geometry, extent_in_nm):
+    return bytes(geometry.ewkb), geometry.srid, extent_in_nm
+
+
+def buffer_geometries(geometries, extent_in_nm):
+    """
+    Buffer many geometries by extent_in_nm in one pass.
+
+    The geometries that aren't cached yet are projected together as a
+    single collection into a coordinate system in meters, buffered, and
+    projected back into WGS84 together.
+
+    Returns a list of multipolygons in the same order as geometries.
+    """
+    keys = [buffer_key(geometry, extent_in_nm) for geometry in geometries]
+    results = [buffer_cache.get(key) for key in keys]
+    missing = [i for i, result in enumerate(results) if result is None]
+
+    if missing:
+        extent_in_m = Distance(nm=extent_in_nm).m
+        collection = GeometryCollection([geometries[i].clone() for i in missing], srid=4326)
+        projected = collection.transform(PROJ_4326_TO_7314, clone=True)
+        buffered = GeometryCollection([geometry.buffer(extent_in_m) for geometry in projected], srid=7314)
+        unprojected = buffered.transform(PROJ_7314_TO_4326, clone=True)
+
+        for i, geometry in zip(missing, unprojected):
+            multipolygon = unwrap_multipolygon(MultiPolygon(geometry) if geometry.geom_type == 'Polygon' else MultiPolygon(list(geometry)))
+            multipolygon.srid = 4326
+            buffer_cache.set(keys[i], multipolygon)
+            results[i] = multipolygon
+
+    return results
+
+
 def buffer_geometry(geometry, extent_in_nm):
     """
     Buffer geometry by projecting it to a coordinate system
@@ -121,15 +147,7 @@ def buffer_geometry(geometry, extent_in_nm):
 
     Reproject the geometry back into WGS84
     """
-    extent_in_m = Distance(nm=extent_in_nm).m
-    projected = geometry.transform(PROJ_4326_TO_7314, clone=True)
-    buffered = projected.buffer(extent_in_m)
-    buffered.srid = 7314
-    unprojected = buffered.transform(PROJ_7314_TO_4326, clone=True)
-    unprojected.srid = 4326
-    multipolygon = unwrap_multipolygon(MultiPolygon(unprojected))
-    multipolygon.srid = 4326
-    return multipolygon
+    return buffer_geometries([geometry], extent_in_nm)[0]
 
 
 def build_circle(point, extent_in_nm):
@@ -0,0 +1,77 @@
+"""
+Process-wide identity maps.
+
+An IdentityMap holds every row of a rarely changing table in memory, keyed
+by pk and by a natural key, so foreign keys to it can be resolved without a
+query per row. The map is loaded in one query on first use and reloaded
+after invalidate() in any process.
+"""
+from app.store import Generational
+
+GENERATION_KEY = 'identity:{name}:generation'
+
+
+class IdentityMap(Generational):
+    key_format = GENERATION_KEY
+
+    def __init__(self, name, queryset, key, check_interval=1.0):
+        super(IdentityMap, self).__init__(name, check_interval)
+        self.queryset = queryset
+        self.key = key
+        self._by_pk = None
+        self._by_key = None
+
+    def load(self):
+        objects = list(self.queryset())
+        self._by_pk = {obj.pk: obj for obj in objects}
+        self._by_key = {getattr(obj, self.key): obj for obj in objects}
+
+    def objects(self):
+        self.current()
+        return self._by_pk
+
+    def add(self, objects):
+        """
+        Remember objects this process has just created.
+        """
+        by_pk = self.objects()
+        for obj in objects:
+            by_pk[obj.pk] = obj
+            self._by_key[getattr(obj, self.key)] = obj
+
+    def get(self, pk):
+        """
+        The object with pk, or None. Rows created since the map was loaded
+        are fetched and added.
+        """
+        if pk is None:
+            return None
+        obj = self.objects().get(pk)
+        if obj is None:
+            obj = self.queryset().filter(pk=pk).first()
+            if obj is not None:
+                self.add([obj])
+        return obj
+
+    def get_by_key(self, value):
+        self.objects()
+        obj = self._by_key.get(value)
+        if obj is None:
+            obj = self.queryset().filter(**{self.key: value}).first()
+            if obj is not None:
+                self.add([obj])
+        return obj
+
+    def by_keys(self, values):
+        """
+        {key: object} of the values that exist, in one query for any not
+        yet in the map.
+        """
+        self.objects()
+        found = {value: self._by_key[value] for value in values if value in self._by_key}
+        missing = set(values).difference(found)
+        if missing:
+            objects = list(self.queryset().filter(**{self.key + '__in': missing}))
+            self.add(objects)
+            found.update((getattr(obj, self.key), obj) for obj in objects)
+        return found
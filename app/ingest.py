@@ -0,0 +1,87 @@
+"""
+Bulk flight plan ingestion.
+
+A batch of flight plans is resolved with one facility lookup, one query for
+the existing flights, one bulk insert and one bulk update, instead of a
+round trip per plan. Plans are dicts in the flightplan.state format.
+
+Existing flights are brought up to their write-behind state first, and only
+their plan columns are written directly; their position goes through the
+write-behind buffer like a tick's, so nothing buffered is lost.
+"""
+import datetime
+import logging
+
+from dateutil.parser import parse
+
+from app import live, simulation, writebehind
+from app.models import Facility, Flight, FlightStatus, PositionReport
+from app.signals import notify_flight
+
+logger = logging.getLogger(__name__)
+
+PLAN_FIELDS = ['departure_facility', 'departure_time', 'arrival_facility', 'arrival_time', 'status', 'total_seconds']
+
+
+def plan_values(data, facilities):
+    etd = parse(data['etd'])
+    total_seconds = int(data['total_eet'])
+    return {
+        'departure_facility': facilities[data['departure']],
+        'departure_time': etd,
+        'arrival_facility': facilities[data['destination']],
+        'arrival_time': etd + datetime.timedelta(seconds=total_seconds),
+        'status': data['state'],
+        'total_seconds': total_seconds,
+    }
+
+
+def ingest(plans):
+    """
+    Create or update the flights for plans and start simulating the active
+    ones. Returns the flights that were written.
+    """
+    # Later plans for the same flight win
+    plans = {data['acid']: data for data in plans}
+    if not plans:
+        return []
+
+    facilities = Facility.objects.by_idents(
+        [data['departure'] for data in plans.values()] + [data['destination'] for data in plans.values()]
+    )
+    existing = {f.ident: f for f in writebehind.overlay(list(Flight.objects.filter(ident__in=plans)))}
+
+    created, updated = [], []
+    for ident, data in plans.items():
+        values = plan_values(data, facilities)
+        if values['departure_facility'].location is None or values['arrival_facility'].location is None:
+            logger.warning('Skipping flight plan %s: facility without a location', ident)
+            continue
+
+        flight = existing.get(ident)
+        if flight is None:
+            flight = Flight(ident=ident, **values)
+            flight.prepare_departure()
+            created.append(flight)
+        else:
+            for name, value in values.items():
+                setattr(flight, name, value)
+            if flight.location:
+                flight.update_position()
+            else:
+                flight.prepare_departure()
+            updated.append(flight)
+
+    Flight.objects.bulk_create(created)
+    # Departures are reported as Flight.save() reports them
+    PositionReport.objects.bulk_create([flight.position_report() for flight in created if flight.moved])
+    Flight.objects.bulk_update(updated, PLAN_FIELDS + ['flight_path'])
+    writebehind.buffer(updated)
+
+    flights = created + updated
+    live.store(flights)
+    for flight in flights:
+        notify_flight(flight)
+
+    simulation.activate([f for f in flights if f.status == FlightStatus.ACTIVE.value])
+    return flights
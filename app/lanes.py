@@ -0,0 +1,116 @@
+"""
+Priority lanes for channel traffic.
+
+Channels are divided into lanes in settings.WORKER_LANES, highest priority
+first. runworkers gives every lane its own pinned workers, never fewer than
+the lane reserves, and hands spare capacity to lanes in priority order, so
+a simulation backlog cannot take workers from interactive map traffic.
+
+Consumers routed with ``route()`` record, per lane, how long each message
+waited between being queued and being handled, and how long handling took.
+Messages are stamped with QUEUED_AT when the scheduler dispatches them and
+when a websocket demultiplexer forwards them, and the stamp is removed
+before the consumer sees the message. The raw websocket.* messages come
+from the interface server without a queue time, so only their handling is
+recorded; report() lists the channels whose wait is not measured.
+"""
+import fnmatch
+import time
+from functools import wraps
+
+from channels import route as channels_route
+from django.conf import settings
+
+from app import metrics
+
+# Not a valid identifier in any of the client payloads
+QUEUED_AT = '__queued_at'
+
+# Channels whose messages are never stamped
+UNSTAMPED = ['websocket.*']
+
+DEFAULT_LANE = {'name': 'default', 'priority': None, 'reserved': 1}
+
+
+def lanes():
+    """
+    The configured lanes, followed by the catch-all default lane.
+    """
+    configured = list(settings.WORKER_LANES)
+    default = dict(DEFAULT_LANE, priority=len(configured))
+    return configured + [default]
+
+
+def lane_for(channel):
+    for lane in settings.WORKER_LANES:
+        if any(fnmatch.fnmatchcase(channel, pattern) for pattern in lane['channels']):
+            return lane['name']
+    return DEFAULT_LANE['name']
+
+
+def stamp(content):
+    content[QUEUED_AT] = time.time()
+    return content
+
+
+def handling(channel):
+    """
+    Timer for the handling time of channel's lane.
+    """
+    return metrics.timed('lane.{}.handle'.format(lane_for(channel)))
+
+
+def observed(channel, consumer):
+    """
+    Wrap consumer to record the wait and handling time of its lane.
+    """
+    lane = lane_for(channel)
+
+    @wraps(consumer)
+    def handle(message, **kwargs):
+        queued_at = message.content.pop(QUEUED_AT, None)
+        if queued_at is not None:
+            metrics.observe('lane.{}.wait'.format(lane), (time.time() - queued_at) * 1000)
+        with metrics.timed('lane.{}.handle'.format(lane)):
+            return consumer(message, **kwargs)
+    return handle
+
+
+def route(channel, consumer, **kwargs):
+    return channels_route(channel, observed(channel, consumer), **kwargs)
+
+
+def unmeasured(lane):
+    """
+    The UNSTAMPED channel patterns served by lane.
+    """
+    if lane.get('channels'):
+        return [p for p in lane['channels'] if any(fnmatch.fnmatchcase(p, u) for u in UNSTAMPED)]
+    pinned = [p for configured in settings.WORKER_LANES for p in configured['channels']]
+    return [u for u in UNSTAMPED if not any(fnmatch.fnmatchcase(u, p) for p in pinned)]
+
+
+def report(snapshot):
+    """
+    Per-lane wait and handling percentiles, and backlog, from a metrics snapshot.
+    """
+    histograms = snapshot['histograms']
+    empty = {'count': 0, 'p50': 0, 'p99': 0, 'mean': 0}
+    rows = []
+    for lane in lanes():
+        name = lane['name']
+        wait = histograms.get('lane.{}.wait'.format(name), empty)
+        handle = histograms.get('lane.{}.handle'.format(name), empty)
+        backlog = histograms.get('supervisor.backlog.{}'.format(name), empty)
+        rows.append({
+            'lane': name,
+            'priority': lane['priority'],
+            'handled': handle['count'],
+            'wait_p50': wait['p50'],
+            'wait_p99': wait['p99'],
+            'handle_p50': handle['p50'],
+            'handle_p99': handle['p99'],
+            'backlog_mean': backlog['mean'],
+            'wait_unmeasured': unmeasured(lane),
+        })
+    return rows
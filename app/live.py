@@ -0,0 +1,253 @@
+"""
+Live flight state shared through Redis.
+
+The simulation and ingestion write the current position, heading, status and
+responsible facility of every flight here, together with its serialized
+GeoJSON at each unclustered detail level, whenever they write the database.
+Viewport syncs, cluster snapshots and weather alerts read it instead of
+querying PostGIS. Flights are bucketed on a grid of CELL_SIZE degree cells so
+viewport queries only touch the cells they cover, and on a coarser grid by
+the extent of their remaining path, so weather checks only read the flights
+whose path may cross the weather.
+
+The state is rebuilt from the database on first use, and again whenever
+Redis has lost it. Readers wait for a rebuild another process is running,
+and read the database instead if it takes longer than LOAD_WAIT seconds.
+"""
+import json
+import time
+
+from django.contrib.gis.geos import LineString, Point
+
+from app import kinematics, lod
+from app.gis import bounding_box_to_polygon
+from app.models import Flight, FlightStatus, facility_map
+from app.spatial import cell_count, extents_overlap, grid_cell, grid_cells
+from app.store import get_redis
+
+RECORDS_KEY = 'live:flights'
+TEXTS_KEY = 'live:flights:{detail}'
+CELL_KEY = 'live:cell:{x}:{y}'
+PATH_CELL_KEY = 'live:path-cell:{x}:{y}'
+LOADED_KEY = 'live:loaded'
+LOADING_KEY = 'live:loading'
+
+CELL_SIZE = 1.0
+PATH_CELL_SIZE = 10.0
+
+LOAD_WAIT = 30
+
+# Viewports covering more cells than this scan every flight instead
+MAX_CELLS = 400
+
+TEXT_DETAILS = [name for name in lod.NAMES if not lod.is_clustered(name)]
+
+LOAD_BATCH_SIZE = 1000
+
+
+class LiveFlight(object):
+    """
+    Read-only view of a flight's live record.
+    """
+
+    def __init__(self, pk, record):
+        self.pk = pk
+        self.ident = record['ident']
+        self.status = record['status']
+        self.x, self.y = record['location']
+        self.heading = record['heading']
+        self.arrival = record['arrival']
+        self.path_extent = record.get('path_extent')
+        self.responsible = facility_map.get(record['facility'])
+
+    @property
+    def location(self):
+        return Point(self.x, self.y, srid=4326)
+
+    @property
+    def remaining_path(self):
+        return LineString(kinematics.path((self.x, self.y), self.arrival).tolist(), srid=4326)
+
+    def within(self, extent):
+        min_x, min_y, max_x, max_y = extent
+        return min_x <= self.x <= max_x and min_y <= self.y <= max_y
+
+
+def record(flight):
+    return {
+        'ident': flight.ident,
+        'status': flight.status,
+        'location': flight.location.coords,
+        'heading': flight.heading,
+        'arrival': flight.arrival.location.coords,
+        'facility': flight.facility_id,
+        'time': flight.time.isoformat() if flight.time else None,
+        'path_extent': list(flight.remaining_path.extent) if flight.remaining_path else None,
+    }
+
+
+def cell_key(x, y):
+    return CELL_KEY.format(x=x, y=y)
+
+
+def path_cell_keys(record):
+    if not record or not record.get('path_extent'):
+        return set()
+    return {PATH_CELL_KEY.format(x=x, y=y) for x, y in grid_cells(record['path_extent'], PATH_CELL_SIZE)}
+
+
+def store(flights):
+    """
+    Write the live state of flights, moving them between grid cells.
+    """
+    flights = [flight for flight in flights if flight.location]
+    if not flights:
+        return
+    redis = get_redis()
+    previous = redis.hmget(RECORDS_KEY, [flight.pk for flight in flights])
+    records = {flight.pk: record(flight) for flight in flights}
+
+    pipe = redis.pipeline(transaction=False)
+    for flight, old in zip(flights, previous):
+        old = json.loads(old.decode('utf-8')) if old is not None else None
+        new_cell = grid_cell(flight.location.x, flight.location.y, CELL_SIZE)
+        if old is not None:
+            old_cell = grid_cell(*old['location'], cell_size=CELL_SIZE)
+            if old_cell != new_cell:
+                pipe.srem(cell_key(*old_cell), flight.pk)
+        pipe.sadd(cell_key(*new_cell), flight.pk)
+
+        old_paths, new_paths = path_cell_keys(old), path_cell_keys(records[flight.pk])
+        for key in old_paths - new_paths:
+            pipe.srem(key, flight.pk)
+        for key in new_paths - old_paths:
+            pipe.sadd(key, flight.pk)
+
+    pipe.hmset(RECORDS_KEY, {pk: json.dumps(values) for pk, values in records.items()})
+    for detail in TEXT_DETAILS:
+        pipe.hmset(TEXTS_KEY.format(detail=detail), {flight.pk: flight.geojson_text(detail) for flight in flights})
+    pipe.execute()
+
+
+def remove(pks):
+    if not pks:
+        return
+    redis = get_redis()
+    previous = redis.hmget(RECORDS_KEY, pks)
+    pipe = redis.pipeline(transaction=False)
+    for pk, old in zip(pks, previous):
+        if old is not None:
+            old = json.loads(old.decode('utf-8'))
+            pipe.srem(cell_key(*grid_cell(*old['location'], cell_size=CELL_SIZE)), pk)
+            for key in path_cell_keys(old):
+                pipe.srem(key, pk)
+    pipe.hdel(RECORDS_KEY, *pks)
+    for detail in TEXT_DETAILS:
+        pipe.hdel(TEXTS_KEY.format(detail=detail), *pks)
+    pipe.execute()
+
+
+def load():
+    """
+    Rebuild the live state from the database. Returns False when another
+    process is already rebuilding it.
+    """
+    redis = get_redis()
+    if not redis.set(LOADING_KEY, 1, nx=True, ex=60):
+        return False
+    try:
+        flights = Flight.objects.filter(location__isnull=False)
+        batch = []
+        for flight in flights.iterator():
+            batch.append(flight)
+            if len(batch) == LOAD_BATCH_SIZE:
+                store(batch)
+                batch = []
+        store(batch)
+        redis.set(LOADED_KEY, 1)
+    finally:
+        redis.delete(LOADING_KEY)
+    return True
+
+
+def ensure_loaded():
+    """
+    Make sure the live state is complete, rebuilding it if need be. Returns
+    False when another process is still rebuilding it after LOAD_WAIT seconds.
+    """
+    redis = get_redis()
+    deadline = time.time() + LOAD_WAIT
+    while not redis.exists(LOADED_KEY):
+        if load():
+            return True
+        if time.time() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def parse(items):
+    return [LiveFlight(int(pk), json.loads(value.decode('utf-8'))) for pk, value in items if value is not None]
+
+
+def from_database(flights):
+    return [LiveFlight(flight.pk, record(flight)) for flight in flights]
+
+
+def members(keys):
+    """
+    Flights in the union of the cell sets at keys.
+    """
+    redis = get_redis()
+    pipe = redis.pipeline(transaction=False)
+    for key in keys:
+        pipe.smembers(key)
+    pks = sorted({int(pk) for found in pipe.execute() for pk in found})
+    return parse(zip(pks, redis.hmget(RECORDS_KEY, pks))) if pks else []
+
+
+def flights_in(extent):
+    """
+    Flights whose location is within extent.
+    """
+    if not ensure_loaded():
+        return from_database(Flight.objects.filter(location__within=bounding_box_to_polygon(extent)))
+    if cell_count(extent, CELL_SIZE) > MAX_CELLS:
+        flights = parse(get_redis().hgetall(RECORDS_KEY).items())
+    else:
+        flights = members(cell_key(x, y) for x, y in grid_cells(extent, CELL_SIZE))
+    return [flight for flight in flights if flight.within(extent)]
+
+
+def flights_crossing(extent):
+    """
+    Flights whose remaining path has an extent overlapping extent.
+    """
+    if not ensure_loaded():
+        return from_database(Flight.objects.filter(remaining_path__intersects=bounding_box_to_polygon(extent)))
+    keys = [PATH_CELL_KEY.format(x=x, y=y) for x, y in grid_cells(extent, PATH_CELL_SIZE)]
+    return [flight for flight in members(keys) if flight.path_extent and extents_overlap(flight.path_extent, extent)]
+
+
+def texts(pks, detail):
+    """
+    Serialized flights at detail, falling back to the database for any
+    that are not in the live state.
+    """
+    if not pks:
+        return []
+    found = []
+    if detail in TEXT_DETAILS:
+        found = get_redis().hmget(TEXTS_KEY.format(detail=detail), pks)
+        missing = [pk for pk, text in zip(pks, found) if text is None]
+    else:
+        missing = pks
+    results = [text.decode('utf-8') for text in found if text is not None]
+    if missing:
+        flights = Flight.objects.filter(pk__in=missing)
+        results.extend(f.geojson_text(detail) for f in flights)
+    return results
+
+
+def active_in(extent):
+    return [flight for flight in flights_in(extent) if flight.status == FlightStatus.ACTIVE.value]
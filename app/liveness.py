@@ -0,0 +1,94 @@
+"""
+Liveness of map sessions.
+
+Every map websocket is recorded in a Redis sorted set scored by when it was
+last heard from: on connect, on every map.move and on the heartbeat the
+browser sends every 30 seconds. Disconnecting removes the session straight
+away. A ``map.reap`` message, rescheduled every MAP_REAP_INTERVAL seconds
+while sessions remain, evicts the sessions that have been silent for longer
+than MAP_SESSION_TTL, so tabs that went away without a disconnect drop out
+of the fan-out too.
+"""
+import time
+
+from django.conf import settings
+
+from app import metrics
+from app import sync as viewport_sync
+from app import viewports
+from app.models import MapSession
+from app.scheduler import schedule
+from app.store import get_redis
+
+ALIVE_KEY = 'sessions:alive'
+REAP_CHANNEL = 'map.reap'
+REAP_LOCK = 'sessions:reaper'
+
+
+def touch(channel):
+    get_redis().zadd(ALIVE_KEY, time.time(), channel)
+
+
+def is_alive(channel):
+    return get_redis().zscore(ALIVE_KEY, channel) is not None
+
+
+def ensure_reaper():
+    """
+    Start the reaper unless it is already scheduled.
+    """
+    interval = settings.MAP_REAP_INTERVAL
+    if get_redis().set(REAP_LOCK, 1, nx=True, ex=int(interval * 3)):
+        schedule(REAP_CHANNEL, {}, time.time() + interval)
+
+
+def connected(channel):
+    touch(channel)
+    ensure_reaper()
+
+
+def evict(channels):
+    """
+    Remove sessions and everything kept for them.
+    """
+    if not channels:
+        return
+    get_redis().zrem(ALIVE_KEY, *channels)
+    sessions = MapSession.objects.filter(channel__in=channels)
+    with_rows = set(sessions.values_list('channel', flat=True))
+    # Deleting the rows unregisters their viewports through the signals
+    sessions.delete()
+    for channel in set(channels).difference(with_rows):
+        viewports.unregister(channel)
+        viewport_sync.forget(channel)
+
+
+def reap(now=None):
+    """
+    Evict sessions not heard from within MAP_SESSION_TTL, and sessions with
+    no liveness entry at all. Returns the number of sessions evicted.
+    """
+    cutoff = (now or time.time()) - settings.MAP_SESSION_TTL
+    alive = {channel.decode('utf-8'): score for channel, score in get_redis().zrange(ALIVE_KEY, 0, -1, withscores=True)}
+    expired = {channel for channel, score in alive.items() if score <= cutoff}
+    expired.update(channel for channel in MapSession.objects.values_list('channel', flat=True) if channel not in alive)
+
+    expired = sorted(expired)
+    evict(expired)
+    metrics.incr('sessions.evicted', len(expired))
+    viewports.rebuild_group_sizes()
+    return len(expired)
+
+
+def run_reaper():
+    """
+    Reap, then schedule the next run while any session remains.
+    """
+    redis = get_redis()
+    reap()
+    if redis.zcard(ALIVE_KEY):
+        interval = settings.MAP_REAP_INTERVAL
+        redis.expire(REAP_LOCK, int(interval * 3))
+        schedule(REAP_CHANNEL, {}, time.time() + interval)
+    else:
+        redis.delete(REAP_LOCK)
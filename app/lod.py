@@ -0,0 +1,67 @@
+"""
+Level of detail for map payloads.
+
+A session's zoom maps to one of a few detail levels. Polygons are simplified
+to the tolerance of the level, flights lose their plan geometry below full
+detail, and at overview zooms flights are sent as counts per grid cell
+instead of individually.
+"""
+from collections import defaultdict
+
+# (highest zoom, detail, simplification tolerance in degrees)
+DETAILS = [
+    (4, 'overview', 0.05),
+    (7, 'reduced', 0.01),
+    (None, 'full', None),
+]
+FULL = 'full'
+NAMES = [name for _, name, _ in DETAILS]
+CLUSTERED = ('overview',)
+
+
+def detail(zoom):
+    """
+    The detail level for a map zoom; full when the zoom is unknown.
+    """
+    if zoom is None:
+        return FULL
+    for max_zoom, name, _ in DETAILS:
+        if max_zoom is None or zoom <= max_zoom:
+            return name
+
+
+def tolerance(name):
+    return next(t for _, n, t in DETAILS if n == name)
+
+
+def simplify(geom, name):
+    tol = tolerance(name)
+    if geom is None or tol is None:
+        return geom
+    return geom.simplify(tol, preserve_topology=True)
+
+
+def is_clustered(name):
+    return name in CLUSTERED
+
+
+def cluster_size(zoom):
+    """
+    Cluster cell size in degrees, roughly a quarter of a map tile.
+    """
+    return 360.0 / 2 ** ((zoom or 0) + 2)
+
+
+def clusters(locations, zoom):
+    """
+    Group point locations into grid cells, returning the count and mean
+    position of each occupied cell.
+    """
+    size = cluster_size(zoom)
+    cells = defaultdict(lambda: [0, 0.0, 0.0])
+    for location in locations:
+        cell = cells[(int(location.x // size), int(location.y // size))]
+        cell[0] += 1
+        cell[1] += location.x
+        cell[2] += location.y
+    return [{'coordinates': [x / count, y / count], 'count': count} for count, x, y in cells.values()]
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from ...benchmark import BENCHMARK_REDIS_DB, MAX_DELIVERY_P99_MS, MAX_TICK_P99_MS, Harness
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the channels pipeline against an in-memory channel layer and a local database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--facilities', type=int, default=50)
+        parser.add_argument('--flights', type=int, default=1000)
+        parser.add_argument('--sessions', type=int, default=20)
+        parser.add_argument('--ticks', type=int, default=10)
+        parser.add_argument('--report-seconds', type=int, default=10)
+        parser.add_argument('--redis-host', default='redis://localhost:6379',
+                            help='Redis server; database {} on it is used and flushed'.format(BENCHMARK_REDIS_DB))
+        parser.add_argument('--max-tick-p99-ms', type=float, default=MAX_TICK_P99_MS)
+        parser.add_argument('--max-delivery-p99-ms', type=float, default=MAX_DELIVERY_P99_MS)
+        parser.add_argument('--keep', action='store_true', help='Keep the seeded data')
+
+    def handle(self, *args, **options):
+        harness = Harness(
+            facilities=options['facilities'],
+            flights=options['flights'],
+            sessions=options['sessions'],
+            report_seconds=options['report_seconds'],
+            ticks=options['ticks'],
+            max_tick_ms=options['max_tick_p99_ms'],
+            max_delivery_ms=options['max_delivery_p99_ms'],
+        )
+        redis_url = '{}/{}'.format(options['redis_host'].rstrip('/'), BENCHMARK_REDIS_DB)
+        with override_settings(REDIS_URL=redis_url, SEND_POSTS=False, MAP_MOVE_DEBOUNCE=0):
+            results = harness.run(keep=options['keep'])
+
+        for name, value in sorted(results.items()):
+            self.stdout.write('{:<28} {:>14.2f}'.format(name, value))
+        self.stdout.write('{} position reports over {} ticks, {} deliveries to {} sessions'.format(
+            results['position_reports'], options['ticks'], results['deliveries'], options['sessions']))
+
+        failures = harness.failures()
+        if failures:
+            raise CommandError('Benchmark over threshold: ' + '; '.join(failures))
@@ -0,0 +1,30 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from ...ingest import ingest
+
+
+class Command(BaseCommand):
+    help = 'Load flight plans from a JSONL file, one flightplan.state message per line'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        total = 0
+        batch = []
+        with open(options['path']) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                batch.append(json.loads(line))
+                if len(batch) >= options['batch_size']:
+                    total += len(ingest(batch))
+                    batch = []
+        if batch:
+            total += len(ingest(batch))
+
+        self.stdout.write(self.style.SUCCESS('Loaded {} flight plans'.format(total)))
@@ -0,0 +1,59 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from ... import lanes, metrics, scheduler
+
+
+class Command(BaseCommand):
+    help = 'Print the hot-path metrics recorded by every worker'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Also sample for this many seconds and report rates over the interval')
+        parser.add_argument('--json', action='store_true', help='Print the raw snapshot as JSON')
+        parser.add_argument('--reset', action='store_true', help='Clear the recorded metrics')
+
+    def handle(self, *args, **options):
+        if options['reset']:
+            metrics.reset()
+            self.stdout.write(self.style.SUCCESS('metrics reset'))
+            return
+
+        snapshot = metrics.snapshot()
+        if options['interval']:
+            before = snapshot
+            time.sleep(options['interval'])
+            snapshot = metrics.snapshot()
+            snapshot['rates'] = metrics.rates(before, snapshot)
+        snapshot['scheduler_pending'] = scheduler.pending()
+        snapshot['lanes'] = lanes.report(snapshot)
+
+        if options['json']:
+            self.stdout.write(json.dumps(snapshot, indent=2, sort_keys=True))
+            return
+
+        self.stdout.write('{:<36} {:>12} {:>12}'.format('counter', 'total', 'per second'))
+        for name, count in sorted(snapshot['counters'].items()):
+            self.stdout.write('{:<36} {:>12} {:>12.2f}'.format(name, count, snapshot.get('rates', {}).get(name, 0)))
+
+        self.stdout.write('')
+        self.stdout.write('{:<36} {:>12} {:>10} {:>10} {:>10}'.format('histogram', 'count', 'mean', 'p50', 'p99'))
+        for name, histogram in sorted(snapshot['histograms'].items()):
+            self.stdout.write('{:<36} {:>12} {:>10.2f} {:>10} {:>10}'.format(
+                name, histogram['count'], histogram['mean'], histogram['p50'], histogram['p99']))
+
+        self.stdout.write('')
+        self.stdout.write('{:<14} {:>8} {:>10} {:>10} {:>10} {:>10} {:>10} {:>12}'.format(
+            'lane', 'priority', 'handled', 'wait p50', 'wait p99', 'run p50', 'run p99', 'backlog'))
+        for row in snapshot['lanes']:
+            self.stdout.write('{lane:<14} {priority:>8} {handled:>10} {wait_p50:>10} {wait_p99:>10} '
+                              '{handle_p50:>10} {handle_p99:>10} {backlog_mean:>12.1f}'.format(**row))
+        for row in snapshot['lanes']:
+            if row['wait_unmeasured']:
+                self.stdout.write('{} wait excludes {}, which arrive without a queue time'.format(
+                    row['lane'], ', '.join(row['wait_unmeasured'])))
+
+        self.stdout.write('')
+        self.stdout.write('{:<36} {:>12}'.format('scheduler pending', snapshot['scheduler_pending']))
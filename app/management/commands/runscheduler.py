@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from ... import scheduler
+
+
+class Command(BaseCommand):
+    help = 'Deliver scheduled channel messages when they are due'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--poll-interval', type=float, default=0.05)
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        self.stdout.write('Scheduler running, {} messages pending'.format(scheduler.pending()))
+        scheduler.run(poll_interval=options['poll_interval'], limit=options['batch_size'])
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from ...supervisor import Supervisor, default_pools
+
+
+class Command(BaseCommand):
+    help = 'Run a pool of channel workers sized from the channel backlog and CPU count'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers-per-cpu', type=int, default=None)
+        parser.add_argument('--messages-per-worker', type=int, default=None)
+        parser.add_argument('--interval', type=float, default=2.0, help='Seconds between resizing the pools')
+
+    def handle(self, *args, **options):
+        supervisor = Supervisor(
+            default_pools(),
+            workers_per_cpu=options['workers_per_cpu'],
+            messages_per_worker=options['messages_per_worker'],
+            interval=options['interval'],
+        )
+        self.stdout.write('Supervising up to {} workers in pools: {}'.format(
+            supervisor.budget, ', '.join(pool.name for pool in supervisor.pools)))
+        supervisor.run()
+        self.stdout.write(self.style.SUCCESS('Workers drained'))
@@ -0,0 +1,205 @@
+"""
+Lightweight metrics shared between processes.
+
+Counters and histograms are accumulated in memory and flushed to Redis at
+most once per FLUSH_INTERVAL, so instrumenting a hot path costs a dict
+update rather than a round trip. Histograms use fixed buckets, which keeps
+them mergeable across workers; timings are recorded in milliseconds.
+
+Use ``timed(name)`` as a decorator or context manager around a stage,
+``incr(name)`` for counts, ``observe(name, value)`` for lags in
+milliseconds and ``observe_count(name, value)`` for sizes, which get
+buckets of their own.
+``snapshot()`` reads the merged totals back, for the ``metrics`` command
+and the metrics view.
+"""
+import atexit
+import threading
+import time
+from collections import Counter, defaultdict
+from functools import wraps
+
+from app.store import get_redis
+
+BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float('inf'))
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000, float('inf'))
+
+# Bucket sets by the scale stored with each histogram
+SCALES = {'ms': BUCKETS, 'count': COUNT_BUCKETS}
+
+COUNTERS_KEY = 'metrics:counters'
+HISTOGRAMS_KEY = 'metrics:histograms'
+HISTOGRAM_KEY = 'metrics:histogram:{name}'
+STARTED_KEY = 'metrics:started'
+
+FLUSH_INTERVAL = 1.0
+
+
+def bucket_label(bound):
+    return 'le_inf' if bound == float('inf') else 'le_{}'.format(bound)
+
+
+def bucket_for(value, buckets=BUCKETS):
+    for bound in buckets:
+        if value <= bound:
+            return bucket_label(bound)
+
+
+def quantile(histogram, q, buckets=BUCKETS):
+    """
+    Upper bound of the bucket containing quantile q of a histogram snapshot.
+    A quantile beyond the last finite bound is reported as that bound, so
+    the result is always valid JSON.
+    """
+    count = histogram.get('count', 0)
+    if not count:
+        return 0
+    seen = 0
+    for bound in buckets[:-1]:
+        seen += histogram.get(bucket_label(bound), 0)
+        if seen >= q * count:
+            return bound
+    return buckets[-2]
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.counters = Counter()
+        self.histograms = defaultdict(Counter)
+        self.sums = Counter()
+        self.scales = {}
+        self.lock = threading.Lock()
+        self.last_flush = time.time()
+
+    def incr(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+        self.maybe_flush()
+
+    def observe(self, name, value, scale='ms'):
+        with self.lock:
+            histogram = self.histograms[name]
+            histogram[bucket_for(value, SCALES[scale])] += 1
+            histogram['count'] += 1
+            self.sums[name] += value
+            self.scales[name] = scale
+        self.maybe_flush()
+
+    def observe_count(self, name, value):
+        self.observe(name, value, scale='count')
+
+    def timed(self, name):
+        return Timer(self, name)
+
+    def maybe_flush(self):
+        if time.time() - self.last_flush >= FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            counters, histograms, sums = self.counters, self.histograms, self.sums
+            self.counters, self.histograms, self.sums = Counter(), defaultdict(Counter), Counter()
+            self.last_flush = time.time()
+        if not (counters or histograms):
+            return
+
+        pipe = get_redis().pipeline(transaction=False)
+        pipe.setnx(STARTED_KEY, time.time())
+        for name, n in counters.items():
+            pipe.hincrby(COUNTERS_KEY, name, n)
+        for name, histogram in histograms.items():
+            key = HISTOGRAM_KEY.format(name=name)
+            pipe.sadd(HISTOGRAMS_KEY, name)
+            for field, n in histogram.items():
+                pipe.hincrby(key, field, n)
+            pipe.hincrbyfloat(key, 'sum', sums[name])
+            pipe.hset(key, 'scale', self.scales.get(name, 'ms'))
+        pipe.execute()
+
+    def snapshot(self):
+        """
+        Merged counters and histograms of every process, as flushed so far,
+        with counter rates since the metrics were started.
+        """
+        redis = get_redis()
+        counters = {k.decode('utf-8'): int(v) for k, v in redis.hgetall(COUNTERS_KEY).items()}
+        histograms = {}
+        for name in sorted(n.decode('utf-8') for n in redis.smembers(HISTOGRAMS_KEY)):
+            raw = redis.hgetall(HISTOGRAM_KEY.format(name=name))
+            buckets = SCALES[raw.pop(b'scale', b'ms').decode('utf-8')]
+            histogram = {k.decode('utf-8'): float(v) if k == b'sum' else int(v) for k, v in raw.items()}
+            count = histogram.get('count', 0)
+            histograms[name] = {
+                'count': count,
+                'mean': histogram.get('sum', 0) / count if count else 0,
+                'p50': quantile(histogram, 0.5, buckets),
+                'p99': quantile(histogram, 0.99, buckets),
+                'buckets': {bucket_label(b): histogram.get(bucket_label(b), 0) for b in buckets},
+            }
+        started = redis.get(STARTED_KEY)
+        snapshot = {
+            'time': time.time(),
+            'started': float(started) if started else None,
+            'counters': counters,
+            'histograms': histograms,
+        }
+        if started:
+            snapshot['rates'] = rates({'time': snapshot['started'], 'counters': {}}, snapshot)
+        return snapshot
+
+    def reset(self):
+        redis = get_redis()
+        names = [n.decode('utf-8') for n in redis.smembers(HISTOGRAMS_KEY)]
+        redis.delete(COUNTERS_KEY, HISTOGRAMS_KEY, STARTED_KEY, *[HISTOGRAM_KEY.format(name=n) for n in names])
+
+
+class Timer(object):
+    """
+    Records the duration of a block in milliseconds, and counts it.
+    """
+
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+
+    def __call__(self, func):
+        @wraps(func)
+        def timed(*args, **kwargs):
+            with Timer(self.registry, self.name):
+                return func(*args, **kwargs)
+        return timed
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.registry.incr(self.name)
+        self.registry.observe(self.name, (time.time() - self.started) * 1000)
+        return False
+
+
+registry = Registry()
+atexit.register(registry.flush)
+
+incr = registry.incr
+observe = registry.observe
+observe_count = registry.observe_count
+timed = registry.timed
+flush = registry.flush
+snapshot = registry.snapshot
+reset = registry.reset
+
+
+def rates(before, after):
+    """
+    Per-second rate of every counter between two snapshots.
+    """
+    elapsed = after['time'] - before['time']
+    if elapsed <= 0:
+        return {}
+    return {
+        name: (count - before['counters'].get(name, 0)) / elapsed
+        for name, count in after['counters'].items()
+    }
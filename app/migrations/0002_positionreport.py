@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import datetime
+
+import django.contrib.gis.db.models.fields
+from django.contrib.gis.geos import LineString, Point
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def tracks_to_reports(apps, schema_editor):
+    """
+    Turn every stored track into position reports, one per point. Tracks
+    carry no times, so the points are spaced report_seconds apart, ending
+    at the flight's last report.
+    """
+    Flight = apps.get_model('app', 'Flight')
+    PositionReport = apps.get_model('app', 'PositionReport')
+    reports = []
+    for flight in Flight.objects.exclude(track=None).iterator():
+        # A track starts with its first point twice
+        coords = [c for i, c in enumerate(flight.track.coords) if i == 0 or c != flight.track.coords[i - 1]]
+        for i, c in enumerate(coords):
+            last = i == len(coords) - 1
+            reports.append(PositionReport(
+                flight_id=flight.pk,
+                time=flight.time - datetime.timedelta(seconds=flight.report_seconds * (len(coords) - 1 - i)),
+                location=Point(c, srid=4326),
+                heading=flight.heading if last else None,
+            ))
+        if len(reports) >= 1000:
+            PositionReport.objects.bulk_create(reports)
+            reports = []
+    PositionReport.objects.bulk_create(reports)
+
+
+def reports_to_tracks(apps, schema_editor):
+    Flight = apps.get_model('app', 'Flight')
+    PositionReport = apps.get_model('app', 'PositionReport')
+    for flight in Flight.objects.all().iterator():
+        reports = PositionReport.objects.filter(flight_id=flight.pk).order_by('time', 'pk')
+        coords = [location.coords for location in reports.values_list('location', flat=True)]
+        if coords:
+            flight.track = LineString([coords[0]] + coords, srid=4326)
+            flight.save(update_fields=['track'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PositionReport',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('time', models.DateTimeField()),
+                ('location', django.contrib.gis.db.models.fields.PointField(srid=4326)),
+                ('heading', models.IntegerField(blank=True, null=True)),
+                ('flight', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='position_reports', to='app.Flight')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='positionreport',
+            index_together=set([('flight', 'time')]),
+        ),
+        migrations.RunPython(tracks_to_reports, reports_to_tracks),
+        migrations.RemoveField(
+            model_name='flight',
+            name='track',
+        ),
+    ]
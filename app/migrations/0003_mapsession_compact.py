@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0002_positionreport'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mapsession',
+            name='compact',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -1,18 +1,51 @@
 import datetime
-import json
 from enum import Enum
 
-from channels import Channel
-from channels.generic.websockets import WebsocketDemultiplexer
+from channels import Channel, Group
 from django.contrib.gis.db import models
 from django.contrib.gis.geos import LineString
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, Value, When
 from django.utils.timezone import UTC
 
+from app import geojson as gj
+from app import kinematics, lod, metrics, viewports
+from app.identity import IdentityMap
+from app.spatial import PreparedIndex
+
 
 class DefaultManager(models.Manager):
     def default(self):
         return self.get_or_create(ident='CZYZ', defaults={'name': 'Toronto Centre'})[0]
 
+    def by_idents(self, idents):
+        """
+        Facilities for the given idents as a dict, creating any that
+        don't exist yet. Known facilities come from facility_map.
+        """
+        idents = set(idents)
+        facilities = facility_map.by_keys(idents)
+        missing = [self.model(ident=ident) for ident in idents.difference(facilities)]
+        if missing:
+            try:
+                with transaction.atomic():
+                    self.bulk_create(missing)
+            except IntegrityError:
+                # Another worker created some of them first
+                for facility in missing:
+                    self.get_or_create(ident=facility.ident)
+            facility_map.invalidate()
+            facilities = facility_map.by_keys(idents)
+        return facilities
+
+    def responsible_for(self, point):
+        """
+        The facility whose responsibility area contains point, or the
+        default facility. Served from the in-memory facility_index.
+        """
+        facilities = facility_index.containing(point)
+        return facilities[0] if facilities else facility_index.default
+
 
 class Facility(models.Model):
     name = models.CharField(max_length=200)
@@ -28,24 +61,54 @@ class Facility(models.Model):
     def __str__(self):
         return self.ident
 
-    def geojson(self):
+    def geojson(self, detail=lod.FULL):
         if self.location:
-            geojson = json.loads(self.location.json)
+            geojson = gj.geometry(self.location)
             geojson.update({
                 'id': self.ident,
                 'properties': {
                     'name': self.name,
-                    'responsibility': json.loads(self.responsibility.json) if self.responsibility else None,
+                    'responsibility': gj.geometry(lod.simplify(self.responsibility, detail)),
                 }
             })
             return geojson
         else:
             return ''
 
-    @staticmethod
-    def send_for_geometry(channel, geometry):
-        for f in Facility.objects.filter(location__intersects=geometry):
-            channel.send(WebsocketDemultiplexer.encode('facility.info', f.geojson()))
+    def geojson_text(self, detail=lod.FULL):
+        return facility_geojson.text(self, detail)
+
+
+facility_geojson = gj.GeoJSONCache('facility', lod.NAMES)
+
+# Every facility by pk and ident, without the responsibility area
+facility_map = IdentityMap('facility', lambda: Facility.objects.defer('responsibility'), 'ident')
+
+
+def responsibility_areas():
+    for facility in Facility.objects.exclude(responsibility=None).order_by('pk'):
+        yield facility.responsibility, facility
+
+
+facility_index = PreparedIndex('facility', responsibility_areas, default=Facility.objects.default)
+
+
+class FlightManager(models.Manager):
+    def bulk_update(self, flights, fields, batch_size=500):
+        """
+        Write the given fields of many flights with one UPDATE per batch.
+
+        Neither save() nor post_save are called; callers are responsible
+        for any derived state and notifications.
+        """
+        fields = [self.model._meta.get_field(name) for name in fields]
+        for i in range(0, len(flights), batch_size):
+            batch = flights[i:i + batch_size]
+            updates = {}
+            for field in fields:
+                whens = [When(pk=f.pk, then=Value(getattr(f, field.attname), output_field=field)) for f in batch]
+                updates[field.attname] = Case(*whens, default=F(field.attname), output_field=field)
+            self.filter(pk__in=[f.pk for f in batch]).update(**updates)
 
 
 class FlightStatus(Enum):
@@ -69,7 +132,6 @@ class Flight(models.Model):
     time = models.DateTimeField(auto_now_add=True)
     location = models.PointField(blank=True, null=True)
     heading = models.IntegerField(blank=True, null=True)
-    track = models.LineStringField(blank=True, null=True)
     remaining_path = models.LineStringField(blank=True, null=True)
     facility = models.ForeignKey(Facility, null=True, related_name='current_flights')
 
@@ -78,70 +140,168 @@ class Flight(models.Model):
     total_seconds = models.IntegerField(default=120)
     report_seconds = models.IntegerField(default=10)
 
+    objects = FlightManager()
+
+    # Serialized geojson() per detail level, cleared whenever the position changes
+    _geojson_texts = None
+
+    # Location of the last position report
+    _reported_location = None
+
     def __str__(self):
         return self.ident
 
-    def geojson(self):
-        geojson = json.loads(self.location.json)
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        flight = super(Flight, cls).from_db(db, field_names, values)
+        if 'location' in field_names:
+            flight._reported_location = flight.location
+        return flight
+
+    @property
+    def departure(self):
+        return facility_map.get(self.departure_facility_id)
+
+    @property
+    def arrival(self):
+        return facility_map.get(self.arrival_facility_id)
+
+    @property
+    def responsible(self):
+        return facility_map.get(self.facility_id)
+
+    def geojson(self, detail=lod.FULL, include_track=False):
+        """
+        Below full detail the flight plan is left out. The track is built
+        from the position reports only with include_track, and is None
+        otherwise. Facilities are read from facility_map rather than loaded
+        per flight.
+        """
+        full = detail == lod.FULL
+        responsible = self.responsible
+        geojson = gj.geometry(self.location)
         geojson.update({
             'id': self.ident,
             'properties': {
-                'departureFacility': self.departure_facility.ident,
+                'departureFacility': self.departure.ident,
                 'departureTime': self.departure_time.isoformat(),
-                'arrivalFacility': self.arrival_facility.ident,
+                'arrivalFacility': self.arrival.ident,
                 'arrivalTime': self.arrival_time.isoformat(),
                 'status': self.status,
                 'time': self.time.isoformat(),
-                'flightPath': json.loads(self.flight_path.json) if self.flight_path else None,
+                'flightPath': gj.geometry(self.flight_path) if full else None,
                 'heading': self.heading,
-                'track': json.loads(self.track.json) if self.track else None,
-                'remaining': json.loads(self.remaining_path.json) if self.remaining_path else None,
-                'facility': self.facility.ident
+                'remaining': gj.geometry(self.remaining_path),
+                'track': gj.geometry(self.track) if include_track else None,
+                'facility': responsible.ident if responsible else None
             }
         })
         return geojson
 
+    def geojson_text(self, detail=lod.FULL):
+        if self._geojson_texts is None:
+            self._geojson_texts = {}
+        if detail not in self._geojson_texts:
+            self._geojson_texts[detail] = gj.dumps(self.geojson(detail))
+        return self._geojson_texts[detail]
+
+    @property
+    def steps(self):
+        return int(self.total_seconds / self.report_seconds)
+
+    @property
+    def track(self):
+        """
+        The flown track, built from the position reports on demand.
+        """
+        coords = [location.coords for location in self.position_reports.order_by('time', 'pk').values_list('location', flat=True)]
+        if not coords:
+            return None
+        if len(coords) == 1:
+            coords.append(coords[0])
+        return LineString(coords, srid=4326)
+
+    @property
+    def moved(self):
+        """
+        Whether the flight has a location other than the last one reported.
+        """
+        if self.location is None:
+            return False
+        return self._reported_location is None or self._reported_location.coords != self.location.coords
+
+    def position_report(self):
+        """
+        A report of the current position, which becomes the last reported one.
+        """
+        self._reported_location = self.location
+        return PositionReport(flight=self, time=self.time, location=self.location, heading=self.heading)
+
+    def update_position(self):
+        """
+        Update the remaining path and responsible facility
+        from the current location.
+        """
+        # Update remaining_path along the great circle
+        self.remaining_path = LineString(
+            kinematics.path(self.location.coords, self.arrival.location.coords).tolist(), srid=4326
+        )
+
+        self.update_facility()
+
+    def update_facility(self):
+        """
+        Update the responsible facility from the current location.
+        """
+        self._geojson_texts = None
+        self.facility = Facility.objects.responsible_for(self.location)
+
+    def prepare_departure(self):
+        """
+        Place a flight without a location at its departure facility.
+        """
+        departure, arrival = self.departure, self.arrival
+        self.location = departure.location
+        if not self.facility_id:
+            self.facility_id = departure.pk
+        if not self.flight_path:
+            self.flight_path = LineString(departure.location, arrival.location)
+        if not self.remaining_path:
+            self.remaining_path = self.flight_path
+
     def save(self, *args, **kwargs):
+        """
+        A position report is only recorded when the location has changed,
+        including the departure of a new flight, not for edits that leave
+        the flight where it was.
+        """
+        self._geojson_texts = None
         if self.location:
-            # Update Track
-            if self.track is None:
-                self.track = LineString(self.location, self.location)
-            else:
-                self.track = LineString(self.track.coords + (self.location.coords,))
-
-            # Update remaining_path
-            self.remaining_path = LineString(self.location, self.arrival_facility.location)
-
-            # Calculate Responsible facility
-            try:
-                self.facility = Facility.objects.get(responsibility__contains=self.location)
-            except Facility.DoesNotExist:
-                self.facility = Facility.objects.default()
+            self.update_position()
         else:
-            self.location = self.departure_facility.location
-            if not self.facility_id:
-                self.facility = self.departure_facility
-            if not self.flight_path:
-                self.flight_path = LineString(self.departure_facility.location, self.arrival_facility.location)
-            if not self.remaining_path:
-                self.remaining_path = self.flight_path
+            self.prepare_departure()
+        reported = self.moved
 
         super(Flight, self).save(*args, **kwargs)
 
-    @staticmethod
-    def send_for_flight_path_geometry(channel, geometry):
-        for f in Flight.objects.filter(flight_path__intersects=geometry):
-            channel.send(WebsocketDemultiplexer.encode('flight.info', f.geojson()))
+        if reported:
+            self.position_report().save()
 
-    @staticmethod
-    def send_for_remaining_path_geometry(channel, geometry):
-        for f in Flight.objects.filter(remaining_path__intersects=geometry):
-            channel.send(WebsocketDemultiplexer.encode('flight.info', f.geojson()))
 
-    @staticmethod
-    def send_for_location_geometry(channel, geometry):
-        for f in Flight.objects.filter(location__intersects=geometry):
-            channel.send(WebsocketDemultiplexer.encode('flight.info', f.geojson()))
+class PositionReport(models.Model):
+    """
+    Append-only history of a flight's reported positions.
+    """
+    flight = models.ForeignKey(Flight, related_name='position_reports')
+    time = models.DateTimeField()
+    location = models.PointField()
+    heading = models.IntegerField(blank=True, null=True)
+
+    class Meta:
+        index_together = [('flight', 'time')]
+
+    def __str__(self):
+        return '{} @ {}'.format(self.flight_id, self.time.isoformat())
 
 
 class CurrentManager(models.Manager):
@@ -156,26 +316,71 @@ class Weather(models.Model):
     class Meta:
         verbose_name_plural = 'weather'
 
-    def geojson(self):
-        geojson = json.loads(self.geom.json)
+    def geojson(self, detail=lod.FULL):
+        geojson = gj.geometry(lod.simplify(self.geom, detail))
         geojson.update({
             'id': self.pk,
             'properties': {}
         })
         return geojson
 
-    @staticmethod
-    def send_for_geometry(channel, geometry):
-        for w in Weather.objects.filter(geom__intersects=geometry):
-            channel.send(WebsocketDemultiplexer.encode('weather.info', w.geojson()))
+    def geojson_text(self, detail=lod.FULL):
+        return weather_geojson.text(self, detail)
+
+
+weather_geojson = gj.GeoJSONCache('weather', lod.NAMES)
+
+
+def weather_areas():
+    for weather in Weather.objects.order_by('pk'):
+        yield weather.geom, weather.pk
+
+
+weather_index = PreparedIndex('weather', weather_areas)
 
 
 class MapSession(models.Model):
     channel = models.CharField(max_length=200, unique=True)
     zoom = models.IntegerField(blank=True, null=True)
     bounds = models.PolygonField(blank=True, null=True)
+    compact = models.BooleanField(default=False)
 
     @staticmethod
-    def send_for_geometry(message, geometry):
-        for ms in MapSession.objects.filter(bounds__intersects=geometry):
-            Channel(ms.channel).send(message)
+    @metrics.timed('send.map_sessions')
+    def send_for_geometry(message, geometry, skip_compact=False):
+        """
+        message is either a message, or a callable returning the message
+        for a detail level (None skips sessions at that level).
+
+        Points are sent to the tile groups containing them, so each
+        message is sent once per tile and detail rather than per session.
+
+        With skip_compact, sessions using the compact format are not sent
+        anything; their (channel, zoom) are returned instead.
+        """
+        if geometry.geom_type == 'Point':
+            sent = 0
+            for group, detail in viewports.groups_for_point(geometry):
+                m = message(detail) if callable(message) else message
+                if m is not None:
+                    Group(group).send(m)
+                    sent += 1
+            metrics.observe_count('fanout.map_groups', sent)
+            metrics.incr('messages.map.groups', sent)
+            sessions = viewports.sessions_for_geometry(geometry, compact_only=True)
+        else:
+            sessions = viewports.sessions_for_geometry(geometry)
+
+        sent = 0
+        skipped = []
+        for channel, zoom, compact in sessions:
+            if compact and skip_compact:
+                skipped.append((channel, zoom))
+                continue
+            m = message(lod.detail(zoom)) if callable(message) else message
+            if m is not None:
+                Channel(channel).send(m)
+                sent += 1
+        metrics.observe_count('fanout.map_sessions', sent)
+        metrics.incr('messages.map', sent)
+        return skipped
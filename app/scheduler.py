@@ -0,0 +1,102 @@
+"""
+Delayed delivery of channel messages.
+
+Instead of sleeping inside a consumer, a message that should run later is
+parked in a Redis sorted set scored by its due time. The ``runscheduler``
+command moves due messages onto their channels, so workers are only ever
+busy with work that is ready to run.
+"""
+import json
+import time
+import uuid
+
+from channels import Channel
+
+from app import lanes, metrics
+from app.store import get_redis
+
+PENDING_KEY = 'scheduler:pending'
+
+# Atomically take up to ARGV[2] entries due at or before ARGV[1], so several
+# schedulers can run side by side without delivering a message twice.
+POP_DUE = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+if #due > 0 then
+    redis.call('ZREM', KEYS[1], unpack(due))
+end
+return due
+"""
+
+_pop_due = None
+
+
+def schedule(channel, content, at):
+    """
+    Deliver content to channel at the unix timestamp at.
+    """
+    entry = json.dumps({'id': uuid.uuid4().hex, 'channel': channel, 'content': content, 'at': at})
+    get_redis().zadd(PENDING_KEY, at, entry)
+
+
+def schedule_in(channel, content, seconds):
+    schedule(channel, content, time.time() + seconds)
+
+
+def pending():
+    return get_redis().zcard(PENDING_KEY)
+
+
+def next_due():
+    """
+    Returns the timestamp of the earliest pending message, or None.
+    """
+    first = get_redis().zrange(PENDING_KEY, 0, 0, withscores=True)
+    return first[0][1] if first else None
+
+
+def pop_due(now, limit=500):
+    global _pop_due
+    if _pop_due is None:
+        _pop_due = get_redis().register_script(POP_DUE)
+    return [json.loads(entry.decode('utf-8')) for entry in _pop_due(keys=[PENDING_KEY], args=[now, limit])]
+
+
+def requeue(entries):
+    """
+    Put popped entries back, due when they were.
+    """
+    pipe = get_redis().pipeline(transaction=False)
+    for entry in entries:
+        pipe.zadd(PENDING_KEY, entry['at'], json.dumps(entry))
+    pipe.execute()
+
+
+def dispatch(limit=500):
+    """
+    Send every message that is due. Returns the number of messages sent.
+
+    Should a send fail, the entries not yet sent are put back before the
+    error is raised, so a full channel delays them instead of losing them.
+    """
+    now = time.time()
+    due = pop_due(now, limit)
+    for i, entry in enumerate(due):
+        try:
+            Channel(entry['channel']).send(lanes.stamp(dict(entry['content'])))
+        except Exception:
+            requeue(due[i:])
+            raise
+        metrics.observe('lag.scheduler', (now - entry['at']) * 1000)
+    return len(due)
+
+
+def run(poll_interval=0.05, limit=500):
+    """
+    Dispatch due messages forever, sleeping until the next one is due.
+    """
+    while True:
+        if dispatch(limit) == limit:
+            continue
+        upcoming = next_due()
+        delay = poll_interval if upcoming is None else upcoming - time.time()
+        time.sleep(min(max(delay, 0), poll_interval))
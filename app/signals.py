@@ -1,70 +1,114 @@
-import json
-from urllib.request import urlopen
-
-import requests
-from channels import Channel
-from channels import Group
 from channels.generic.websockets import WebsocketDemultiplexer
 from django.conf import settings
-from django.db.models.signals import post_save, pre_delete
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
 from django.dispatch import receiver
 
-from app.models import Weather, Facility, Flight, MapSession, FlightStatus
-from hackweek import settings
+from app import alerts, live, lod, metrics, sync, viewports, webhooks, wire, writebehind
+from app.geojson import dumps, encode
+from app.models import Weather, Facility, Flight, MapSession, facility_index, facility_geojson, facility_map, weather_geojson, weather_index
+
+
+@metrics.timed('signal.notify_flight')
+def notify_flight(flight, frames=None):
+    """
+    Send a position report to map sessions watching the flight
+    and to the position report receiver.
+
+    Records for compact sessions are added to the frames FrameBuffer when
+    one is given, and sent straight away otherwise.
+    """
+    def message(detail):
+        # Clustered sessions get cluster snapshots from the tick instead
+        if lod.is_clustered(detail):
+            return None
+        return encode('flight.info', flight.geojson_text(detail))
+
+    compact = MapSession.send_for_geometry(message, flight.location, skip_compact=True)
+    if compact:
+        wire.send_positions(flight, compact, message, frames)
+
+    if settings.SEND_POSTS:
+        # The receiver gets the flown track as well
+        webhooks.post(settings.POSITION_REPORT_POST_URL, dumps(flight.geojson(include_track=True)))
+
+
+@receiver(pre_save, sender=Flight)
+@metrics.timed('signal.flight_saving')
+def flight_saving(sender, **kwargs):
+    # Keep a flush that has not locked the row yet from reverting the save
+    if kwargs['instance'].pk:
+        writebehind.discard([kwargs['instance'].pk])
 
 
 @receiver(post_save, sender=Flight)
+@metrics.timed('signal.flight_saved')
 def flight_saved(sender, **kwargs):
     flight = kwargs['instance']
+    # A full save has written the buffered columns, as flights are overlaid
+    # before they are changed
+    writebehind.discard([flight.pk])
     if flight.location:
-        message = WebsocketDemultiplexer.encode('flight.info', flight.geojson())
-        MapSession.send_for_geometry(message, flight.location)
+        live.store([flight])
+        notify_flight(flight)
 
-        if settings.SEND_POSTS:
-            requests.post(settings.POSITION_REPORT_POST_URL, data={'data': json.dumps(flight.geojson())})
+
+@receiver(post_delete, sender=Flight)
+@metrics.timed('signal.flight_deleted')
+def flight_deleted(sender, **kwargs):
+    pk = kwargs['instance'].pk
+    writebehind.forget([pk])
+    live.remove([pk])
+
+
+@receiver([post_save, post_delete], sender=Facility)
+@metrics.timed('signal.facility_changed')
+def facility_changed(sender, **kwargs):
+    facility_index.invalidate()
+    facility_map.invalidate()
+    facility_geojson.invalidate(kwargs['instance'].pk)
 
 
 @receiver(post_save, sender=MapSession)
+@metrics.timed('signal.map_session_saved')
 def map_session_saved(sender, **kwargs):
     ms = kwargs['instance']
-    channel = Channel(ms.channel)
-    Facility.send_for_geometry(channel, ms.bounds)
-    Flight.send_for_location_geometry(channel, ms.bounds)
-    Weather.send_for_geometry(channel, ms.bounds)
+    if ms.bounds:
+        viewports.register(ms.channel, ms.bounds, ms.zoom, ms.compact)
+    sync.sync(ms.channel, ms.bounds, ms.zoom)
+
+
+@receiver(post_delete, sender=MapSession)
+@metrics.timed('signal.map_session_deleted')
+def map_session_deleted(sender, **kwargs):
+    viewports.unregister(kwargs['instance'].channel)
+    sync.forget(kwargs['instance'].channel)
 
 
 @receiver(pre_delete, sender=Weather)
+@metrics.timed('signal.weather_deleted')
 def weather_deleted(sender, **kwargs):
     weather = kwargs['instance']
+    weather_geojson.invalidate(weather.pk)
+    alerts.weather_deleted(weather)
     message = WebsocketDemultiplexer.encode('weather.info', {'id': weather.pk, 'remove': True})
-    for ms in MapSession.objects.filter(bounds__intersects=weather.geom):
-        Channel(ms.channel).send(message)
+    MapSession.send_for_geometry(message, weather.geom)
+
+
+@receiver(post_delete, sender=Weather)
+@metrics.timed('signal.weather_removed')
+def weather_removed(sender, **kwargs):
+    weather_index.invalidate()
 
 
 @receiver(post_save, sender=Weather)
+@metrics.timed('signal.weather_saved')
 def weather_saved(sender, **kwargs):
     weather = kwargs['instance']
 
     # Notify about weather
-    message = WebsocketDemultiplexer.encode('weather.info', weather.geojson())
-
-    for ms in MapSession.objects.filter(bounds__intersects=weather.geom):
-        Channel(ms.channel).send(message)
+    weather_index.invalidate()
+    weather_geojson.invalidate(weather.pk)
+    MapSession.send_for_geometry(lambda detail: encode('weather.info', weather.geojson_text(detail)), weather.geom)
 
     # Notify Flights with the weather in their path
-    for f in Flight.objects.filter(remaining_path__intersects=weather.geom).exclude(status=FlightStatus.CLOSED.value):
-        stream = 'aircraft.alert'
-        payload = {
-            'acid': f.ident,
-            'responsible': f.facility.ident,
-            'alert': 'Weather in flight path',
-            'url': '{url}/#{zoom}/{point.y}/{point.x}'.format(url=settings.BASE_URL, zoom=6, point=f.remaining_path.interpolate_normalized(0.5))
-        }
-        if settings.SEND_POSTS:
-            requests.post(settings.WEATHER_ALERT_POST_URL, data={'data': json.dumps(payload)})
-
-        message = WebsocketDemultiplexer.encode(stream, payload)
-
-        if f.status == FlightStatus.ACTIVE:
-            for ms in MapSession.objects.filter(bounds__intersects=f.location):
-                Channel(ms.channel).send(message)
+    alerts.weather_changed(weather)
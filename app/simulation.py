@@ -0,0 +1,195 @@
+"""
+Batched flight simulation.
+
+Active flights are grouped into buckets by their report_seconds. Each bucket
+is advanced by a single ``flightplan.tick`` message per interval, which moves
+every due flight in the bucket, buffers the new positions for write-behind
+persistence, sends the position reports and refreshes the cluster snapshots
+of zoomed-out maps. The next tick is handed to the scheduler, so no worker
+waits between ticks.
+"""
+import datetime
+import time
+
+from django.conf import settings
+from django.contrib.gis.geos import LineString, Point
+from django.utils.timezone import UTC
+
+from app import alerts, kinematics, live, metrics, sync, wire, writebehind
+from app.models import Flight, FlightStatus, weather_index
+from app.scheduler import schedule
+from app.signals import notify_flight
+from app.store import get_redis
+
+TICK_CHANNEL = 'flightplan.tick'
+TICK_LOCK = 'simulation:tick:{report_seconds}'
+
+
+def now():
+    return datetime.datetime.now(tz=UTC())
+
+
+def ensure_tick(report_seconds):
+    """
+    Start the tick for a report_seconds bucket unless one is already running.
+    """
+    lock = TICK_LOCK.format(report_seconds=report_seconds)
+    if get_redis().set(lock, 1, nx=True, ex=report_seconds * 3):
+        schedule(TICK_CHANNEL, {'report_seconds': report_seconds, 'at': time.time()}, time.time())
+
+
+def activate(flights):
+    """
+    Make flights active and make sure their buckets are ticking.
+    """
+    buckets = set()
+    for flight in flights:
+        if flight.status == FlightStatus.FILED.value:
+            flight.status = FlightStatus.ACTIVE.value
+            flight.current_step = 0
+            flight.save()
+        if flight.status == FlightStatus.ACTIVE.value:
+            buckets.add(flight.report_seconds)
+    for report_seconds in buckets:
+        ensure_tick(report_seconds)
+
+
+def move(flights):
+    """
+    Move flights one step along the great circle of their flight path, and
+    follow the great circle with their remaining path.
+    """
+    if not flights:
+        return
+    for flight in flights:
+        flight.current_step += 1
+
+    current = [flight.location.coords for flight in flights]
+    origins = [flight.flight_path.coords[0] for flight in flights]
+    destinations = [flight.flight_path.coords[-1] for flight in flights]
+    fractions = [flight.current_step / flight.steps for flight in flights]
+    positions, headings, remaining = kinematics.advance(current, origins, destinations, fractions)
+
+    for flight, position, heading, destination, distance in zip(flights, positions, headings, destinations, remaining):
+        x, y = position.tolist()
+        flight.heading = int(round(heading)) % 360
+        flight.location = Point(x, y, srid=4326)
+        flight.remaining_path = LineString(kinematics.path(position, destination, distance).tolist(), srid=4326)
+
+
+def step(flights, timestamp):
+    """
+    Advance flights by one report.
+    """
+    moving = []
+    for flight in flights:
+        # End of flight
+        if flight.current_step >= flight.steps:
+            if settings.CIRCLE_ON_ARRIVAL:
+                # Flights shorter than one report never got a heading
+                flight.heading = ((flight.heading or 0) + 45) % 360
+            else:
+                flight.status = FlightStatus.CLOSED.value
+
+        # Active flight; Move Flight
+        else:
+            moving.append(flight)
+
+    move(moving)
+
+    moved = set(id(flight) for flight in moving)
+    for flight in flights:
+        flight.time = timestamp
+        if id(flight) in moved:
+            flight.update_facility()
+        else:
+            flight.update_position()
+
+
+def advance(report_seconds, timestamp):
+    """
+    Advance every due, active flight in a report_seconds bucket.
+
+    A flight is due once half an interval has passed since its last report,
+    so flights activated between ticks join the next one. Positions still
+    waiting in the write-behind buffer take precedence over the database.
+    """
+    due = timestamp - datetime.timedelta(seconds=report_seconds / 2)
+    with metrics.timed('tick.load'):
+        flights = list(Flight.objects.filter(
+            status=FlightStatus.ACTIVE.value,
+            report_seconds=report_seconds,
+            location__isnull=False,
+            time__lte=due,
+        ))
+        flights = [
+            flight for flight in writebehind.overlay(flights)
+            if flight.status == FlightStatus.ACTIVE.value and flight.time <= due
+        ]
+    metrics.observe_count('tick.flights', len(flights))
+
+    with metrics.timed('tick.step'):
+        step(flights, timestamp)
+
+    with metrics.timed('tick.write'):
+        writebehind.buffer(flights)
+        live.store(flights)
+
+    with metrics.timed('tick.notify'):
+        frames = wire.FrameBuffer()
+        for flight in flights:
+            notify_flight(flight, frames)
+        frames.flush()
+
+    with metrics.timed('tick.clusters'):
+        sync.refresh_clusters()
+
+    with metrics.timed('tick.weather'):
+        check_weather(flights)
+
+    return flights
+
+
+def check_weather(flights):
+    """
+    Alert flights whose updated remaining path now crosses weather, using
+    the in-memory weather index.
+    """
+    pairs = []
+    for flight in flights:
+        if flight.status != FlightStatus.CLOSED.value and flight.remaining_path:
+            pairs.extend((flight, weather_pk) for weather_pk in weather_index.intersecting(flight.remaining_path))
+    alerts.alert(pairs)
+
+
+def schedule_next(report_seconds, at):
+    """
+    Schedule the next tick of a bucket and extend its lock.
+    """
+    # Keep the cadence anchored to the original schedule, skipping
+    # any intervals that were missed while the tick was running
+    next_at = at + report_seconds
+    while next_at < time.time():
+        next_at += report_seconds
+    get_redis().expire(TICK_LOCK.format(report_seconds=report_seconds), report_seconds * 3)
+    schedule(TICK_CHANNEL, {'report_seconds': report_seconds, 'at': next_at}, next_at)
+
+
+def tick(report_seconds, at):
+    """
+    Run one tick of a bucket and schedule the next one, or stop the
+    bucket once it has no active flights left. A tick that fails still
+    schedules the next one, so the bucket keeps retrying.
+    """
+    metrics.observe('lag.tick', (time.time() - at) * 1000)
+    try:
+        advance(report_seconds, now())
+    except Exception:
+        schedule_next(report_seconds, at)
+        raise
+
+    active = Flight.objects.filter(status=FlightStatus.ACTIVE.value, report_seconds=report_seconds)
+    if active.exists():
+        schedule_next(report_seconds, at)
+    else:
+        get_redis().delete(TICK_LOCK.format(report_seconds=report_seconds))
@@ -0,0 +1,119 @@
+"""
+Process-local spatial indexes.
+
+Geometries that rarely change are kept in memory as prepared geometries,
+bucketed on a regular longitude/latitude grid, so point and geometry
+lookups don't need a database round trip.
+"""
+import math
+from collections import defaultdict
+
+from app.store import Generational
+
+GENERATION_KEY = 'spatial:{name}:generation'
+
+
+def grid_cell(x, y, cell_size):
+    return int(math.floor(x / cell_size)), int(math.floor(y / cell_size))
+
+
+def cell_count(extent, cell_size):
+    min_x, min_y, max_x, max_y = extent
+    (x0, y0), (x1, y1) = grid_cell(min_x, min_y, cell_size), grid_cell(max_x, max_y, cell_size)
+    return (x1 - x0 + 1) * (y1 - y0 + 1)
+
+
+def extents_overlap(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def grid_cells(extent, cell_size):
+    """
+    The (x, y) grid cells covered by extent.
+    """
+    min_x, min_y, max_x, max_y = extent
+    (x0, y0), (x1, y1) = grid_cell(min_x, min_y, cell_size), grid_cell(max_x, max_y, cell_size)
+    return [(x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+
+class GridIndex(object):
+    """
+    Buckets items by the grid cells their extent covers.
+
+    An extent covering more cells than there are items is answered by
+    comparing it with the extent of every item instead, so long paths
+    don't walk hundreds of mostly empty cells.
+    """
+
+    def __init__(self, cell_size=1.0):
+        self.cell_size = cell_size
+        self.cells = defaultdict(list)
+        self.items = []
+
+    def insert(self, item, extent):
+        self.items.append((item, extent))
+        for cell in grid_cells(extent, self.cell_size):
+            self.cells[cell].append(item)
+
+    def query_point(self, x, y):
+        return self.cells.get(grid_cell(x, y, self.cell_size), [])
+
+    def query_extent(self, extent):
+        if cell_count(extent, self.cell_size) > len(self.items):
+            for item, item_extent in self.items:
+                if extents_overlap(extent, item_extent):
+                    yield item
+            return
+        seen = set()
+        for cell in grid_cells(extent, self.cell_size):
+            for item in self.cells.get(cell, []):
+                if id(item) not in seen:
+                    seen.add(id(item))
+                    yield item
+
+
+class PreparedIndex(Generational):
+    """
+    In-memory index of (geometry, item) pairs returned by loader, rebuilt
+    after invalidate() in any process. Items are matched in the order the
+    loader returns them.
+    """
+    key_format = GENERATION_KEY
+
+    def __init__(self, name, loader, default=None, cell_size=1.0, check_interval=1.0):
+        super(PreparedIndex, self).__init__(name, check_interval)
+        self.loader = loader
+        self.default_loader = default
+        self.cell_size = cell_size
+        self._grid = None
+        self._default = None
+
+    def load(self):
+        grid = GridIndex(self.cell_size)
+        for order, (geometry, item) in enumerate(self.loader()):
+            grid.insert((order, geometry.prepared, item), geometry.extent)
+        self._default = self.default_loader() if self.default_loader else None
+        self._grid = grid
+
+    def grid(self):
+        self.current()
+        return self._grid
+
+    @property
+    def default(self):
+        self.grid()
+        return self._default
+
+    def containing(self, point):
+        """
+        Items whose geometry contains point.
+        """
+        candidates = sorted(self.grid().query_point(point.x, point.y), key=lambda entry: entry[0])
+        return [item for order, prepared, item in candidates if prepared.contains(point)]
+
+    def intersecting(self, geometry):
+        """
+        Items whose geometry intersects geometry.
+        """
+        candidates = sorted(self.grid().query_extent(geometry.extent), key=lambda entry: entry[0])
+        return [item for order, prepared, item in candidates if prepared.intersects(geometry)]
@@ -37,6 +37,7 @@ var Map = L.Class.extend({
       facilities: L.geoJson(),
       flights: L.geoJson(),
       weather: L.geoJson(),
+      clusters: L.layerGroup(),
       temp: L.layerGroup(),
     }
 
@@ -62,6 +63,7 @@ var Map = L.Class.extend({
         this.layers.facilities,
         this.layers.flights,
         this.layers.weather,
+        this.layers.clusters,
         this.layers.temp
       ]
     });
@@ -120,6 +122,26 @@ var Map = L.Class.extend({
   moveEnd: function (event) {
     this.sendPosition();
     this.layers.temp.clearLayers();
+    this.dropOutOfBounds();
+  },
+
+  inBounds: function (flight) {
+    var coordinates = flight.coordinates;
+    return coordinates != undefined && this.map.getBounds().contains([coordinates[1], coordinates[0]]);
+  },
+
+  dropOutOfBounds: function () {
+    // Live updates are not tracked per session, so flights that moved out
+    // of view get no removal from the server; drop them here
+    Object.keys(this.db['flight']).forEach(function (ident) {
+      var flight = this.db['flight'][ident];
+      if (!this.inBounds(flight)) {
+        if (flight.properties.layer != undefined) {
+          this.layers.flights.removeLayer(flight.properties.layer);
+        }
+        delete this.db['flight'][ident];
+      }
+    }.bind(this));
   },
 
   flight: function (flight) {
@@ -134,6 +156,13 @@ var Map = L.Class.extend({
       this.layers.flights.removeLayer(existing.properties.layer);
     }
 
+    // Left the viewport. Updates come per map tile, which can be outside
+    // the viewport, so flights outside the bounds are dropped too
+    if (flight.remove == true || !this.inBounds(flight)) {
+      delete this.db['flight'][flight.id];
+      return;
+    }
+
     if (flight.properties.status == 'active') {
       flight.mouseover = function (e) {
         this.mouseover = 'flight';
@@ -182,11 +211,37 @@ var Map = L.Class.extend({
 
   },
 
+  position: function (ident, lng, lat, heading, status) {
+    // Compact update of a flight that has already been sent in full
+    var flight = this.db['flight'][ident];
+    if (flight == undefined) {
+      return;
+    }
+    flight.coordinates = [lng, lat];
+    flight.properties.heading = heading;
+    if (status != flight.properties.status || !this.inBounds(flight)) {
+      flight.properties.status = status;
+      this.flight(flight);
+      return;
+    }
+    this.stats.flight.html(parseInt(this.stats.flight.html()) + 1);
+    if (flight.properties.layer != undefined) {
+      flight.properties.layer.eachLayer(function (layer) {
+        layer.setLatLng([lat, lng]);
+        layer.setRotationAngle(heading);
+      });
+    }
+  },
+
   facility: function (facility) {
     this.stats.facility.html(parseInt(this.stats.facility.html()) + 1);
-    // Always on map once drawn
+    // On map once drawn, until it leaves the viewport or is resent at another level of detail
     var existing = this.db['facility'][facility.id];
-    if (existing == undefined) {
+    if (existing != undefined) {
+      this.layers.facilities.removeLayer(existing.properties.layer);
+      delete this.db['facility'][facility.id];
+    }
+    if (facility.remove != true) {
 
       facility.mouseover = function (e) {
         this.mouseover = 'facility';
@@ -241,6 +296,23 @@ var Map = L.Class.extend({
       this.layers.weather.addLayer(weather.properties.layer);
       this.db['weather'][weather.id] = weather;
     }
+    else {
+      delete this.db['weather'][weather.id];
+    }
+  },
+
+  cluster: function (payload) {
+    // Replaces individual flights at low zoom levels
+    this.layers.clusters.clearLayers();
+    payload.cells.forEach(function (cell) {
+      var marker = L.circleMarker([cell.coordinates[1], cell.coordinates[0]], {
+        radius: 8 + Math.min(Math.log(cell.count) * 3, 20),
+        color: '#2b6cb0',
+        weight: 1
+      });
+      marker.bindTooltip(String(cell.count), {permanent: true, direction: 'center', className: 'cluster-label'});
+      this.layers.clusters.addLayer(marker);
+    }.bind(this));
   },
 
   other: function (payload) {
@@ -4,7 +4,9 @@ var WebsocketWrapper = L.Class.extend({
   socket: null,
 
   options: {
-    ws_path: ""
+    ws_path: "",
+    compact: false,  // Ask for binary position updates
+    heartbeat: null  // Milliseconds between map.heartbeat messages, off unless set
   },
 
   initialize: function (options) {
@@ -14,9 +16,13 @@ var WebsocketWrapper = L.Class.extend({
 
     console.debug("Connecting to " + this.ws_uri);
 
-    this.socket = new ReconnectingWebSocket(this.ws_uri);
+    this.socket = new ReconnectingWebSocket(this.ws_uri, null, {binaryType: 'arraybuffer'});
 
     this.socket.onmessage = function (message) {
+      if (message.data instanceof ArrayBuffer) {
+        this.routeFrame(message.data);
+        return;
+      }
       var data = JSON.parse(message.data)
       if (data.stream != null) {
         console.debug("StreamMessage: %s", data.stream);
@@ -31,6 +37,14 @@ var WebsocketWrapper = L.Class.extend({
       console.debug("Connected to socket");
     };
 
+    if (this.options.heartbeat) {
+      setInterval(function () {
+        if (this.socket.readyState == WebSocket.OPEN) {
+          this.send('map.heartbeat', {});
+        }
+      }.bind(this), this.options.heartbeat);
+    }
+
     this.socket.onclose = function () {
       console.debug("Disconnected from socket");
     };
@@ -60,6 +74,9 @@ var WebsocketWrapper = L.Class.extend({
       case 'flight.info':
         this.map.flight(payload);
         break;
+      case 'flight.cluster':
+        this.map.cluster(payload);
+        break;
       case 'weather.info':
         this.map.weather(payload);
         break;
@@ -68,8 +85,35 @@ var WebsocketWrapper = L.Class.extend({
     }
   },
 
+  routeFrame: function (buffer) {
+    // Header (kind: uint8, count: uint16), then count records of
+    // (ident length: uint8, ident, lng: float32, lat: float32, heading: int16, status: uint8)
+    var view = new DataView(buffer);
+    var count = view.getUint16(1, true);
+    var offset = 3;
+    for (var i = 0; i < count; i++) {
+      var length = view.getUint8(offset);
+      var ident = String.fromCharCode.apply(null, new Uint8Array(buffer, offset + 1, length));
+      offset += 1 + length;
+      this.map.position(
+        ident,
+        view.getFloat32(offset, true),
+        view.getFloat32(offset + 4, true),
+        view.getInt16(offset + 8, true),
+        this.statuses[view.getUint8(offset + 10)]
+      );
+      offset += 11;
+    }
+  },
+
+  statuses: ['filed', 'active', 'closed'],
+
   sendMove: function (bounds, zoom) {
-    return this.send('map.move', {'bounds': bounds, 'zoom': zoom});
+    var payload = {'bounds': bounds, 'zoom': zoom};
+    if (this.options.compact) {
+      payload.format = 'compact';
+    }
+    return this.send('map.move', payload);
   }
 
 
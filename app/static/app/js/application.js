@@ -1,5 +1,9 @@
 $(function () {
-  window.socket = new WebsocketWrapper({'ws_path': '/app/map'});
+  window.socket = new WebsocketWrapper({
+    'ws_path': '/app/map',
+    'compact': window.location.search.indexOf('compact') != -1,
+    'heartbeat': 30000
+  });
   window.map = new Map(socket);
 
   setTimeout(function () {
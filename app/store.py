@@ -0,0 +1,61 @@
+import time
+
+import redis
+from django.conf import settings
+
+_client = None
+
+
+def get_redis():
+    """
+    Shared Redis connection for application state that lives outside the
+    channel layer (simulation locks, schedules, indexes).
+    """
+    global _client
+    if _client is None:
+        _client = redis.StrictRedis.from_url(settings.REDIS_URL)
+    return _client
+
+
+class Generational(object):
+    """
+    Process-local state that is loaded on first use and reloaded after
+    invalidate(). The generation counter is shared through Redis, so
+    invalidating in one process is picked up by the others within
+    check_interval seconds. Subclasses set key_format and implement load().
+    """
+    key_format = None
+
+    def __init__(self, name, check_interval=1.0):
+        self.name = name
+        self.check_interval = check_interval
+        self._loaded = False
+        self._generation = None
+        self._checked = 0
+
+    @property
+    def generation_key(self):
+        return self.key_format.format(name=self.name)
+
+    def invalidate(self):
+        self._loaded = False
+        self._generation = get_redis().incr(self.generation_key)
+        self._checked = time.time()
+
+    def load(self):
+        raise NotImplementedError
+
+    def current(self):
+        """
+        Load the state unless this process has the latest generation.
+        """
+        now = time.time()
+        if now - self._checked >= self.check_interval:
+            generation = int(get_redis().get(self.generation_key) or 0)
+            if generation != self._generation:
+                self._loaded = False
+                self._generation = generation
+            self._checked = now
+        if not self._loaded:
+            self.load()
+            self._loaded = True
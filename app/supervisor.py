@@ -0,0 +1,220 @@
+"""
+Adaptive worker pool supervisor.
+
+Runs ``runworker`` processes in one pool per lane (see app.lanes), pinned
+to the lane's channels with --only-channels, plus a catch-all pool that
+excludes them, and one ``runscheduler``. Every interval the backlog of each
+pool's channels is read from the channel layer and the pool is grown or
+shrunk between its reserved minimum and its maximum, within a total budget
+of WORKERS_PER_CPU workers per core handed out in priority order. Workers
+that exit unexpectedly are restarted. Shrinking and shutdown send SIGINT
+and give workers DRAIN_TIMEOUT seconds to finish the message they are
+handling before they are killed.
+"""
+import fnmatch
+import logging
+import math
+import multiprocessing
+import signal
+import subprocess
+import sys
+import time
+
+from channels import DEFAULT_CHANNEL_LAYER
+from channels.asgi import channel_layers
+from django.conf import settings
+
+from app import lanes, metrics
+
+logger = logging.getLogger(__name__)
+
+DRAIN_TIMEOUT = 10
+
+
+def queue_depths(channels):
+    """
+    Messages waiting on each channel of the default layer.
+    """
+    layer = channel_layers[DEFAULT_CHANNEL_LAYER].channel_layer
+    if hasattr(layer, 'channel_statistics'):
+        return {channel: layer.channel_statistics(channel)['messages_count'] for channel in channels}
+    # asgi_redis keeps each channel as a list of message ids
+    return {
+        channel: layer.connection(layer.consistent_hash(channel)).llen(layer.prefix + channel)
+        for channel in channels
+    }
+
+
+def matches(channel, patterns):
+    return any(fnmatch.fnmatchcase(channel, pattern) for pattern in patterns)
+
+
+class Pool(object):
+    """
+    Worker processes serving the channels matching patterns, or every
+    channel not in exclude when patterns is None.
+    """
+
+    def __init__(self, name, patterns=None, exclude=(), minimum=1, maximum=None, priority=0, command='runworker'):
+        self.name = name
+        self.priority = priority
+        self.patterns = patterns
+        self.exclude = list(exclude)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.command = command
+        self.processes = []
+        self.stopping = []
+
+    def serves(self, channel):
+        if self.patterns is None:
+            return not matches(channel, self.exclude)
+        return matches(channel, self.patterns)
+
+    def arguments(self):
+        args = [sys.executable, sys.argv[0], self.command]
+        if self.command == 'runworker':
+            for pattern in self.patterns or []:
+                args += ['--only-channels', pattern]
+            for pattern in self.exclude:
+                args += ['--exclude-channels', pattern]
+        return args
+
+    def spawn(self):
+        process = subprocess.Popen(self.arguments())
+        self.processes.append(process)
+        logger.info('Started %s worker %s', self.name, process.pid)
+        return process
+
+    def stop_one(self):
+        process = self.processes.pop()
+        process.send_signal(signal.SIGINT)
+        self.stopping.append((process, time.time() + DRAIN_TIMEOUT))
+        logger.info('Draining %s worker %s', self.name, process.pid)
+
+    def reap(self):
+        """
+        Restart crashed workers and kill drained ones that overran.
+        """
+        for process in list(self.processes):
+            if process.poll() is not None:
+                logger.warning('%s worker %s exited with %s, restarting', self.name, process.pid, process.returncode)
+                self.processes.remove(process)
+                self.spawn()
+                metrics.incr('supervisor.restarts')
+
+        now = time.time()
+        stopping = []
+        for process, deadline in self.stopping:
+            if process.poll() is None:
+                if now > deadline:
+                    process.kill()
+                stopping.append((process, deadline))
+        self.stopping = [(p, d) for p, d in stopping if p.poll() is None]
+
+    def scale(self, size):
+        """
+        Grow to size at once, but shrink by one worker per call.
+        """
+        while len(self.processes) < size:
+            self.spawn()
+        if len(self.processes) > size:
+            self.stop_one()
+
+    def shutdown(self):
+        while self.processes:
+            self.stop_one()
+
+    @property
+    def running(self):
+        return len(self.processes) + len(self.stopping)
+
+
+def default_pools():
+    """
+    A pool per lane, the catch-all lane excluding every pinned channel.
+    """
+    pools = []
+    pinned = []
+    for lane in lanes.lanes():
+        patterns = lane.get('channels')
+        pools.append(Pool(
+            lane['name'],
+            patterns,
+            exclude=[] if patterns else pinned,
+            minimum=lane.get('reserved', 1),
+            maximum=lane.get('max'),
+            priority=lane['priority'],
+        ))
+        pinned.extend(patterns or [])
+    return pools
+
+
+class Supervisor(object):
+
+    def __init__(self, pools, workers_per_cpu=None, messages_per_worker=None, interval=2.0):
+        self.pools = pools
+        self.scheduler = Pool('scheduler', command='runscheduler')
+        self.budget = multiprocessing.cpu_count() * (workers_per_cpu or settings.WORKERS_PER_CPU)
+        self.messages_per_worker = messages_per_worker or settings.WORKER_MESSAGES_PER_WORKER
+        self.interval = interval
+        self.running = False
+
+    def channels(self):
+        return channel_layers[DEFAULT_CHANNEL_LAYER].router.channels
+
+    def backlogs(self):
+        depths = queue_depths(self.channels())
+        backlogs = {}
+        for pool in self.pools:
+            backlogs[pool.name] = sum(depth for channel, depth in depths.items() if pool.serves(channel))
+            metrics.observe_count('supervisor.backlog.' + pool.name, backlogs[pool.name])
+        return backlogs
+
+    def sizes(self, backlogs):
+        """
+        Workers wanted by each pool: its reserved minimum, plus one per
+        messages_per_worker of backlog, capped by its maximum and by what
+        is left of the budget, highest priority first.
+        """
+        sizes = {pool.name: pool.minimum for pool in self.pools}
+        spare = self.budget - sum(sizes.values())
+        for pool in sorted(self.pools, key=lambda p: (p.priority, -backlogs[p.name])):
+            wanted = max(pool.minimum, int(math.ceil(backlogs[pool.name] / float(self.messages_per_worker))))
+            if pool.maximum is not None:
+                wanted = min(wanted, pool.maximum)
+            extra = max(0, min(wanted - pool.minimum, spare))
+            sizes[pool.name] += extra
+            spare -= extra
+        return sizes
+
+    def step(self):
+        sizes = self.sizes(self.backlogs())
+        for pool in self.pools:
+            pool.reap()
+            pool.scale(sizes[pool.name])
+        self.scheduler.reap()
+
+    def stop(self, *args):
+        self.running = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        self.running = True
+        self.scheduler.scale(1)
+        try:
+            while self.running:
+                self.step()
+                time.sleep(self.interval)
+        finally:
+            self.drain()
+
+    def drain(self):
+        for pool in self.pools + [self.scheduler]:
+            pool.shutdown()
+        # Workers that overrun DRAIN_TIMEOUT are killed by reap()
+        while any(pool.running for pool in self.pools + [self.scheduler]):
+            for pool in self.pools + [self.scheduler]:
+                pool.reap()
+            time.sleep(0.1)
@@ -0,0 +1,209 @@
+"""
+Delta synchronization of map session viewports.
+
+The ids of the features each session has been sent are kept in Redis. When
+a session moves, only the features entering its bounds are sent, and the
+ones that left are sent as removals. When the session's detail level
+changes every feature in bounds is sent again at the new level, and at
+clustered levels flights are replaced by a cluster snapshot. Clustered
+sessions are not sent live position updates; each simulation tick refreshes
+their snapshot instead, at most every MAP_CLUSTER_REFRESH seconds.
+
+Flights reaching a session through live updates (see app.viewports) are
+not recorded here. The map drops flights outside its bounds itself, so a
+flight that moves out of view needs no removal, and one that moved into
+view is sent again in full on the next move.
+
+Moves are coalesced per session: each map.move only records the latest
+viewport and schedules a map.sync, and a sync that is no longer for the
+latest move is skipped, or abandoned part way through.
+"""
+import json
+
+from channels import Channel
+from channels.generic.websockets import WebsocketDemultiplexer
+from django.conf import settings
+
+from app import live, lod, viewports
+from app.geojson import encode
+from app.models import Facility, Weather, facility_geojson, weather_geojson
+from app.scheduler import schedule_in
+from app.store import get_redis
+
+SENT_KEY = 'viewport:sent:{channel}:{stream}'
+DETAIL_KEY = 'viewport:detail:{channel}'
+MOVE_KEY = 'viewport:move:{channel}'
+SEQ_KEY = 'viewport:seq:{channel}'
+CLUSTERED_KEY = 'viewport:clustered'
+CLUSTER_THROTTLE_KEY = 'viewport:cluster-sent:{channel}'
+
+SYNC_CHANNEL = 'map.sync'
+
+# Check for a newer move after this many sends
+CANCEL_CHECK_INTERVAL = 50
+
+
+def queue_move(channel_name, bounds, zoom, compact=False):
+    """
+    Record the latest viewport of a session and schedule a debounced sync.
+    """
+    redis = get_redis()
+    pipe = redis.pipeline()
+    pipe.set(MOVE_KEY.format(channel=channel_name), json.dumps({'bounds': bounds, 'zoom': zoom, 'compact': compact}))
+    pipe.incr(SEQ_KEY.format(channel=channel_name))
+    seq = pipe.execute()[1]
+    schedule_in(SYNC_CHANNEL, {'channel': channel_name, 'seq': seq}, settings.MAP_MOVE_DEBOUNCE)
+
+
+def take_move(channel_name, seq):
+    """
+    The latest viewport recorded for the session, or None when seq is no
+    longer the latest move.
+    """
+    redis = get_redis()
+    latest, move = redis.mget(SEQ_KEY.format(channel=channel_name), MOVE_KEY.format(channel=channel_name))
+    if latest is None or int(latest) != seq or move is None:
+        return None
+    return json.loads(move.decode('utf-8'))
+
+
+class Superseded(Exception):
+    pass
+
+
+def facilities_in(bounds):
+    return dict(Facility.objects.filter(location__intersects=bounds).values_list('ident', 'pk'))
+
+
+def facility_texts(pks, detail):
+    return facility_geojson.get_many(Facility.objects.filter(pk__in=pks).defer('responsibility'), detail)
+
+
+def flights_in(bounds):
+    return {flight.ident: flight.pk for flight in live.flights_in(bounds.extent)}
+
+
+def flight_texts(pks, detail):
+    return live.texts(pks, detail)
+
+
+def weather_in(bounds):
+    return {str(pk): pk for pk in Weather.objects.filter(geom__intersects=bounds).values_list('pk', flat=True)}
+
+
+def weather_texts(pks, detail):
+    return weather_geojson.get_many(Weather.objects.filter(pk__in=pks).defer('geom'), detail)
+
+
+# stream, ids in bounds -> {feature id: pk}, (pks, detail) -> serialized features
+STREAMS = [
+    ('facility.info', facilities_in, facility_texts),
+    ('flight.info', flights_in, flight_texts),
+    ('weather.info', weather_in, weather_texts),
+]
+
+
+def flight_clusters(extent, zoom):
+    return lod.clusters(live.active_in(extent), zoom)
+
+
+def send_clusters(channel, extent, zoom):
+    cells = flight_clusters(extent, zoom) if extent else []
+    channel.send(WebsocketDemultiplexer.encode('flight.cluster', {'cells': cells}))
+
+
+def refresh_clusters():
+    """
+    Send a fresh cluster snapshot to every clustered session that has not
+    had one for MAP_CLUSTER_REFRESH seconds. Returns the number sent.
+    """
+    redis = get_redis()
+    channels = [c.decode('utf-8') for c in redis.smembers(CLUSTERED_KEY)]
+    if not channels:
+        return 0
+
+    interval = int(settings.MAP_CLUSTER_REFRESH * 1000)
+    pipe = redis.pipeline(transaction=False)
+    for channel_name in channels:
+        pipe.set(CLUSTER_THROTTLE_KEY.format(channel=channel_name), 1, nx=True, px=interval)
+    due = [channel_name for channel_name, acquired in zip(channels, pipe.execute()) if acquired]
+
+    sessions = viewports.viewports(due)
+    for channel_name, (bbox, zoom) in sessions.items():
+        send_clusters(Channel(channel_name), bbox, zoom)
+    return len(sessions)
+
+
+def sync(channel_name, bounds, zoom=None):
+    """
+    Bring the session on channel_name up to date with its new bounds and zoom.
+    """
+    redis = get_redis()
+    seq_key = SEQ_KEY.format(channel=channel_name)
+    seq = redis.get(seq_key)
+    channel = Channel(channel_name)
+
+    def check():
+        if redis.get(seq_key) != seq:
+            raise Superseded()
+
+    detail = lod.detail(zoom)
+    detail_key = DETAIL_KEY.format(channel=channel_name)
+    previous = redis.getset(detail_key, detail)
+    previous = previous.decode('utf-8') if previous else None
+    clustered = lod.is_clustered(detail)
+
+    try:
+        sync_streams(redis, channel, channel_name, bounds, detail, previous, check)
+    except Superseded:
+        # Resend everything at the newer viewport's detail level
+        redis.delete(detail_key)
+        return
+
+    if clustered:
+        redis.sadd(CLUSTERED_KEY, channel_name)
+    elif lod.is_clustered(previous):
+        redis.srem(CLUSTERED_KEY, channel_name)
+    if clustered or lod.is_clustered(previous):
+        send_clusters(channel, bounds.extent if clustered and bounds else None, zoom)
+
+
+def sync_streams(redis, channel, channel_name, bounds, detail, previous, check):
+    clustered = lod.is_clustered(detail)
+    sends = 0
+
+    for stream, features_in, texts in STREAMS:
+        check()
+        key = SENT_KEY.format(channel=channel_name, stream=stream)
+        sent = {i.decode('utf-8') for i in redis.smembers(key)}
+        if not bounds or (clustered and stream == 'flight.info'):
+            current = {}
+        else:
+            current = features_in(bounds)
+
+        for feature_id in sent.difference(current):
+            channel.send(WebsocketDemultiplexer.encode(stream, {'id': feature_id, 'remove': True}))
+
+        if previous == detail:
+            entering = [pk for feature_id, pk in current.items() if feature_id not in sent]
+        else:
+            entering = list(current.values())
+        for text in texts(entering, detail) if entering else []:
+            channel.send(encode(stream, text))
+            sends += 1
+            if sends % CANCEL_CHECK_INTERVAL == 0:
+                check()
+
+        pipe = redis.pipeline()
+        pipe.delete(key)
+        if current:
+            pipe.sadd(key, *current)
+        pipe.execute()
+
+
+def forget(channel_name):
+    keys = [SENT_KEY.format(channel=channel_name, stream=stream) for stream, _, _ in STREAMS]
+    keys += [key.format(channel=channel_name) for key in (DETAIL_KEY, MOVE_KEY, SEQ_KEY, CLUSTER_THROTTLE_KEY)]
+    redis = get_redis()
+    redis.delete(*keys)
+    redis.srem(CLUSTERED_KEY, channel_name)
@@ -1,3 +1,494 @@
-from django.test import TestCase
+import datetime
+import json
+import time
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.contrib.gis.geos import LineString, Point, Polygon
+from django.test import SimpleTestCase, override_settings
+from django.utils.timezone import UTC
+
+from app import alerts, gis, kinematics, lanes, lod, metrics, scheduler, store, sync, wire, writebehind
+from app.models import Flight, Weather
+from app.spatial import GridIndex, grid_cells
+from app.supervisor import Pool, Supervisor
+
+
+class LevelOfDetailTest(SimpleTestCase):
+
+    def test_detail_by_zoom(self):
+        self.assertEqual(lod.detail(None), lod.FULL)
+        self.assertEqual(lod.detail(0), 'overview')
+        self.assertEqual(lod.detail(4), 'overview')
+        self.assertEqual(lod.detail(5), 'reduced')
+        self.assertEqual(lod.detail(7), 'reduced')
+        self.assertEqual(lod.detail(8), lod.FULL)
+        self.assertEqual(lod.detail(18), lod.FULL)
+
+    def test_only_overview_is_clustered(self):
+        self.assertEqual([name for name in lod.NAMES if lod.is_clustered(name)], ['overview'])
+
+    def test_simplify_keeps_full_detail(self):
+        self.assertIsNone(lod.simplify(None, 'overview'))
+        point = Point(1, 2)
+        self.assertIs(lod.simplify(point, lod.FULL), point)
+
+    def test_clusters_count_and_average_each_cell(self):
+        # 22.5 degree cells at zoom 2
+        locations = [Point(1, 1), Point(3, 3), Point(30, 1)]
+        clusters = sorted(lod.clusters(locations, 2), key=lambda c: c['count'])
+        self.assertEqual(clusters, [
+            {'coordinates': [30.0, 1.0], 'count': 1},
+            {'coordinates': [2.0, 2.0], 'count': 2},
+        ])
+
+    def test_clusters_split_at_cell_edges(self):
+        clusters = lod.clusters([Point(-0.5, 0.5), Point(0.5, 0.5)], 2)
+        self.assertEqual(sorted(c['count'] for c in clusters), [1, 1])
+
+
+class GridIndexTest(SimpleTestCase):
+
+    def setUp(self):
+        self.index = GridIndex(cell_size=1.0)
+        self.index.insert('west', (-10.5, 0.5, -9.5, 1.5))
+        self.index.insert('east', (9.5, 0.5, 10.5, 1.5))
+
+    def test_grid_cells(self):
+        self.assertEqual(grid_cells((0.5, 0.5, 1.5, 0.9), 1.0), [(0, 0), (1, 0)])
+        self.assertEqual(grid_cells((-0.5, -0.5, -0.1, -0.1), 1.0), [(-1, -1)])
+
+    def test_small_extent_uses_cells(self):
+        self.assertEqual(list(self.index.query_extent((-10, 1, -9.8, 1.2))), ['west'])
+        self.assertEqual(list(self.index.query_extent((0, 0, 0.5, 0.5))), [])
+
+    def test_large_extent_scans_items(self):
+        # Covers far more cells than there are items
+        self.assertEqual(sorted(self.index.query_extent((-50, -50, 50, 50))), ['east', 'west'])
+        self.assertEqual(list(self.index.query_extent((-50, -50, 0, 50))), ['west'])
+        self.assertEqual(list(self.index.query_extent((-50, 10, 50, 50))), [])
+
+
+class KinematicsTest(SimpleTestCase):
+
+    def test_distance(self):
+        # A degree of arc is about 60 nautical miles
+        self.assertAlmostEqual(float(kinematics.distance_nm(0, 0, 1, 0)), 60.04, places=2)
+        self.assertAlmostEqual(float(kinematics.distance_nm(10, 20, 10, 20)), 0)
+
+    def test_bearing(self):
+        self.assertAlmostEqual(float(kinematics.bearing(0, 0, 1, 0)), 90)
+        self.assertAlmostEqual(float(kinematics.bearing(0, 0, 0, 1)), 0)
+        self.assertAlmostEqual(float(kinematics.bearing(0, 0, -1, 0)), 270)
+
+    def test_interpolate(self):
+        lon, lat = kinematics.interpolate(0, 0, 10, 0, [0, 0.5, 1])
+        np.testing.assert_allclose(lon, [0, 5, 10], atol=1e-9)
+        np.testing.assert_allclose(lat, [0, 0, 0], atol=1e-9)
+
+    def test_interpolate_coincident_points(self):
+        lon, lat = kinematics.interpolate(3, 4, 3, 4, 0.5)
+        self.assertAlmostEqual(float(lon), 3)
+        self.assertAlmostEqual(float(lat), 4)
+
+    def test_advance(self):
+        current = [(0, 0), (0, 0)]
+        origins = [(0, 0), (0, 0)]
+        destinations = [(10, 0), (0, 10)]
+        positions, headings, remaining = kinematics.advance(current, origins, destinations, [0.5, 1])
+        np.testing.assert_allclose(positions, [(5, 0), (0, 10)], atol=1e-9)
+        np.testing.assert_allclose(headings, [90, 0], atol=1e-9)
+        np.testing.assert_allclose(remaining, [kinematics.distance_nm(5, 0, 10, 0), 0], atol=1e-6)
+
+    def test_path_follows_the_great_circle(self):
+        start, end = (-75.7, 45.4), (-123.1, 49.2)
+        path = kinematics.path(start, end)
+        self.assertEqual(tuple(path[0]), start)
+        self.assertEqual(tuple(path[-1]), end)
+        steps = kinematics.distance_nm(path[:-1, 0], path[:-1, 1], path[1:, 0], path[1:, 1])
+        self.assertLessEqual(steps.max(), kinematics.PATH_SEGMENT_NM)
+        # North of the straight line between the ends
+        self.assertGreater(path[len(path) // 2][1], 49.2)
+
+    def test_path_point_count(self):
+        self.assertEqual(len(kinematics.path((0, 0), (0, 0))), 2)
+        self.assertEqual(len(kinematics.path((0, 0), (170, 0))), kinematics.MAX_PATH_POINTS)
+
+
+class WireFormatTest(SimpleTestCase):
+
+    def test_record(self):
+        flight = Flight(ident='AC123', location=Point(-75.5, 45.25), heading=359.6, status='active')
+        data = wire.record(flight)
+        self.assertEqual(data[0], 5)
+        self.assertEqual(data[1:6], b'AC123')
+        self.assertEqual(len(data), 6 + wire.RECORD.size)
+        self.assertEqual(wire.RECORD.unpack(data[6:]), (-75.5, 45.25, 0, wire.STATUSES.index('active')))
+
+    def test_record_without_heading(self):
+        flight = Flight(ident='AC1', location=Point(1, 2), heading=None, status='active')
+        self.assertEqual(wire.RECORD.unpack(wire.record(flight)[4:])[2], 0)
+
+    def test_frames_are_chunked(self):
+        records = [wire.struct.pack('<B', 1) + b'A' + wire.RECORD.pack(i, 0, 0, 0)
+                   for i in range(wire.MAX_RECORDS + 1)]
+        frames = list(wire.frames(records))
+        self.assertEqual(len(frames), 2)
+        self.assertEqual(wire.HEADER.unpack(frames[0][:wire.HEADER.size]), (wire.POSITIONS, wire.MAX_RECORDS))
+        self.assertEqual(wire.HEADER.unpack(frames[1][:wire.HEADER.size]), (wire.POSITIONS, 1))
+        self.assertEqual(frames[1][wire.HEADER.size:], records[-1])
+
+    def test_no_frames_without_records(self):
+        self.assertEqual(list(wire.frames([])), [])
+
+
+@override_settings(REDIS_URL='redis://localhost:6379/15')
+class WriteBehindTest(SimpleTestCase):
+
+    def setUp(self):
+        store._client = None
+        writebehind._take = None
+        self.redis = store.get_redis()
+        self.redis.flushdb()
+
+    def tearDown(self):
+        self.redis.flushdb()
+        store._client = None
+        writebehind._take = None
+
+    def flight(self, x, current_step):
+        return Flight(
+            pk=1,
+            ident='TEST1',
+            status='active',
+            time=datetime.datetime(2016, 11, 18, 12, current_step, tzinfo=UTC()),
+            location=Point(x, 45, srid=4326),
+            heading=90,
+            remaining_path=LineString((x, 45), (-70, 45), srid=4326),
+            current_step=current_step,
+        )
+
+    def assertAt(self, flight, x, current_step):
+        self.assertEqual(flight.location.coords, (x, 45))
+        self.assertEqual(flight.current_step, current_step)
+
+    def test_overlay_applies_buffered_state(self):
+        writebehind.buffer([self.flight(-74, 3)])
+        stale = writebehind.overlay([self.flight(-76, 1)])[0]
+        self.assertAt(stale, -74, 3)
+        self.assertEqual(stale.remaining_path.coords, ((-74, 45), (-70, 45)))
+        self.assertFalse(stale.moved)
+
+    def test_overlay_without_buffered_state(self):
+        self.assertAt(writebehind.overlay([self.flight(-76, 1)])[0], -76, 1)
+
+    def test_discard_drops_buffered_state(self):
+        writebehind.buffer([self.flight(-74, 3)])
+        writebehind.discard([1])
+        self.assertAt(writebehind.overlay([self.flight(-76, 1)])[0], -76, 1)
+
+    def test_reports_only_moves(self):
+        flight = self.flight(-74, 3)
+        writebehind.buffer([flight])
+        flight.current_step += 1
+        writebehind.buffer([flight])
+        self.assertEqual(self.redis.llen(writebehind.REPORTS_KEY), 1)
+
+    def test_overlay_sees_entries_being_flushed(self):
+        writebehind.buffer([self.flight(-74, 3)])
+        flights, reports = writebehind.take()
+        self.assertEqual(len(flights), 1)
+        self.assertEqual(len(reports), 1)
+        self.assertAt(writebehind.overlay([self.flight(-76, 1)])[0], -74, 3)
+
+        # Newer state buffered during the flush wins
+        writebehind.buffer([self.flight(-73, 4)])
+        self.assertAt(writebehind.overlay([self.flight(-76, 1)])[0], -73, 4)
+
+        writebehind.discard([1])
+        self.assertAt(writebehind.overlay([self.flight(-76, 1)])[0], -76, 1)
+
+    def test_forget_drops_state_and_reports(self):
+        other = self.flight(-74, 3)
+        other.pk = 2
+        writebehind.buffer([self.flight(-74, 3), other])
+        writebehind.take()
+        writebehind.buffer([self.flight(-73, 4)])
+        writebehind.forget([1])
+        self.assertEqual(list(writebehind.pending([1, 2])), [2])
+        reports = self.redis.lrange(writebehind.REPORTS_KEY, 0, -1)
+        reports += self.redis.lrange(writebehind.FLUSHING_REPORTS_KEY, 0, -1)
+        self.assertEqual([json.loads(report.decode('utf-8'))['flight'] for report in reports], [2])
+
+    def test_take_merges_into_failed_flush(self):
+        writebehind.buffer([self.flight(-74, 3)])
+        writebehind.take()
+        writebehind.buffer([self.flight(-73, 4)])
+        flights, reports = writebehind.take()
+        self.assertEqual(len(flights), 1)
+        self.assertEqual(len(reports), 2)
+        self.assertAt(writebehind.overlay([self.flight(-76, 1)])[0], -73, 4)
+        self.assertEqual(self.redis.hlen(writebehind.FLIGHTS_KEY), 0)
+
+
+class SupervisorSizingTest(SimpleTestCase):
+
+    def setUp(self):
+        self.supervisor = Supervisor([
+            Pool('map', ['map.*'], minimum=1, maximum=3, priority=0),
+            Pool('simulation', ['simulation.*'], minimum=1, priority=1),
+            Pool('default', exclude=['map.*', 'simulation.*'], minimum=1, priority=2),
+        ], workers_per_cpu=1, messages_per_worker=10)
+        self.supervisor.budget = 6
+
+    def sizes(self, **backlogs):
+        return self.supervisor.sizes(dict({'map': 0, 'simulation': 0, 'default': 0}, **backlogs))
+
+    def test_minimums_without_backlog(self):
+        self.assertEqual(self.sizes(), {'map': 1, 'simulation': 1, 'default': 1})
+        self.assertEqual(self.sizes(map=5), {'map': 1, 'simulation': 1, 'default': 1})
+
+    def test_spare_budget_in_priority_order(self):
+        self.assertEqual(self.sizes(simulation=100, default=100), {'map': 1, 'simulation': 4, 'default': 1})
+        self.assertEqual(self.sizes(map=20, simulation=100, default=100), {'map': 2, 'simulation': 3, 'default': 1})
+
+    def test_maximum_caps_a_pool(self):
+        self.assertEqual(self.sizes(map=100, default=30), {'map': 3, 'simulation': 1, 'default': 2})
+
+    def test_minimums_are_kept_over_budget(self):
+        self.supervisor.budget = 2
+        self.assertEqual(self.sizes(map=100), {'map': 1, 'simulation': 1, 'default': 1})
+
+    def test_catch_all_pool_serves_unpinned_channels(self):
+        default = self.supervisor.pools[2]
+        self.assertTrue(default.serves('websocket.receive'))
+        self.assertFalse(default.serves('map.move'))
+        self.assertTrue(self.supervisor.pools[0].serves('map.move'))
+        self.assertFalse(self.supervisor.pools[0].serves('simulation.tick'))
+
+
+@override_settings(REDIS_URL='redis://localhost:6379/15')
+class SchedulerTest(SimpleTestCase):
+
+    def setUp(self):
+        store._client = None
+        scheduler._pop_due = None
+        self.redis = store.get_redis()
+        self.redis.flushdb()
+
+    def tearDown(self):
+        self.redis.flushdb()
+        store._client = None
+        scheduler._pop_due = None
+
+    def test_pop_due_takes_due_entries_in_order(self):
+        now = time.time()
+        scheduler.schedule('later', {}, now + 60)
+        scheduler.schedule('second', {}, now - 1)
+        scheduler.schedule('first', {}, now - 2)
+        self.assertEqual([entry['channel'] for entry in scheduler.pop_due(now)], ['first', 'second'])
+        self.assertEqual(scheduler.pop_due(now), [])
+        self.assertEqual(scheduler.pending(), 1)
+
+    def test_pop_due_limit(self):
+        now = time.time()
+        for i in range(3):
+            scheduler.schedule('due', {'i': i}, now - 1)
+        self.assertEqual(len(scheduler.pop_due(now, limit=2)), 2)
+        self.assertEqual(scheduler.pending(), 1)
+
+    @mock.patch('app.scheduler.Channel')
+    def test_dispatch_stamps_messages(self, channel):
+        scheduler.schedule('flightplan.tick', {'report_seconds': 5}, time.time() - 1)
+        self.assertEqual(scheduler.dispatch(), 1)
+        channel.assert_called_once_with('flightplan.tick')
+        content = channel.return_value.send.call_args[0][0]
+        self.assertEqual(content['report_seconds'], 5)
+        self.assertIn(lanes.QUEUED_AT, content)
+
+    @mock.patch('app.scheduler.Channel')
+    def test_dispatch_requeues_unsent_entries(self, channel):
+        channel.return_value.send.side_effect = [None, Exception('full'), None]
+        now = time.time()
+        for i in range(3):
+            scheduler.schedule('due', {'i': i}, now - 3 + i)
+        with self.assertRaises(Exception):
+            scheduler.dispatch()
+        entries = scheduler.pop_due(now)
+        self.assertEqual([entry['content'] for entry in entries], [{'i': 1}, {'i': 2}])
+        self.assertEqual([entry['at'] for entry in entries], [now - 2, now - 1])
+
+
+class MetricsTest(SimpleTestCase):
+
+    def histogram(self, values, buckets):
+        histogram = {'count': len(values)}
+        for value in values:
+            label = metrics.bucket_for(value, buckets)
+            histogram[label] = histogram.get(label, 0) + 1
+        return histogram
+
+    def test_quantile(self):
+        histogram = self.histogram([1, 3, 3, 40], metrics.BUCKETS)
+        self.assertEqual(metrics.quantile(histogram, 0.5), 5)
+        self.assertEqual(metrics.quantile(histogram, 0.99), 50)
+        self.assertEqual(metrics.quantile({}, 0.5), 0)
+
+    def test_overflow_reports_last_finite_bound(self):
+        histogram = self.histogram([20000, 30000], metrics.BUCKETS)
+        self.assertEqual(metrics.quantile(histogram, 0.99), 10000)
+
+    def test_count_buckets(self):
+        histogram = self.histogram([0, 0, 30000], metrics.COUNT_BUCKETS)
+        self.assertEqual(metrics.quantile(histogram, 0.5, metrics.COUNT_BUCKETS), 0)
+        self.assertEqual(metrics.quantile(histogram, 0.99, metrics.COUNT_BUCKETS), 50000)
+
+
+class AntimeridianTest(SimpleTestCase):
+
+    def test_ring_crossing_the_antimeridian(self):
+        polygon = Polygon(((170, 0), (-170, 0), (-170, 10), (170, 10), (170, 0)))
+        self.assertEqual(gis.unwrap_polygon(polygon).coords, (
+            ((170, 0), (190, 0), (190, 10), (170, 10), (170, 0)),
+        ))
+
+    def test_ring_unwrapped_westwards(self):
+        polygon = Polygon(((-175, 0), (175, 0), (175, 10), (-175, 10), (-175, 0)))
+        self.assertEqual(gis.unwrap_polygon(polygon).coords[0][1], (-185, 0))
+
+    def test_holes_follow_the_exterior(self):
+        polygon = Polygon(
+            ((170, 0), (-170, 0), (-170, 10), (170, 10), (170, 0)),
+            ((172, 2), (172, 8), (-172, 8), (-172, 2), (172, 2)),
+        )
+        self.assertEqual(gis.unwrap_polygon(polygon).coords[1], ((172, 2), (172, 8), (188, 8), (188, 2), (172, 2)))
+
+    def test_other_rings_are_left_alone(self):
+        polygon = Polygon(((10, 0), (20, 0), (20, 10), (10, 10), (10, 0)))
+        self.assertIs(gis.unwrap_polygon(polygon), polygon)
+
+
+class BufferTest(SimpleTestCase):
+
+    def setUp(self):
+        gis.buffer_cache.entries.clear()
+
+    def tearDown(self):
+        gis.buffer_cache.entries.clear()
+
+    def geometries(self):
+        return [
+            Point(-75.7, 45.4, srid=4326),
+            LineString((-80, 43), (-73, 45), srid=4326),
+            Polygon(((-100, 50), (-95, 50), (-95, 55), (-100, 55), (-100, 50)), srid=4326),
+        ]
+
+    def test_batch_matches_single_geometries(self):
+        batch = gis.buffer_geometries(self.geometries(), 20)
+        gis.buffer_cache.entries.clear()
+        for geometry, buffered in zip(self.geometries(), batch):
+            single = gis.buffer_geometry(geometry, 20)
+            self.assertEqual(buffered.geom_type, 'MultiPolygon')
+            self.assertEqual(buffered.srid, 4326)
+            self.assertTrue(buffered.equals_exact(single, 1e-9))
+
+    def test_buffer_contains_geometry(self):
+        for geometry, buffered in zip(self.geometries(), gis.buffer_geometries(self.geometries(), 20)):
+            self.assertTrue(buffered.contains(geometry))
+
+    def test_cached_results_are_copies(self):
+        point = Point(-75.7, 45.4, srid=4326)
+        first = gis.buffer_geometry(point, 20)
+        first.srid = 3857
+        self.assertEqual(gis.buffer_geometry(point, 20).srid, 4326)
+
+
+@override_settings(REDIS_URL='redis://localhost:6379/15')
+class AlertDeduplicationTest(SimpleTestCase):
+
+    def setUp(self):
+        store._client = None
+        alerts._known.clear()
+        self.redis = store.get_redis()
+        self.redis.flushdb()
+        self.flights = [Flight(pk=1, ident='TEST1'), Flight(pk=2, ident='TEST2')]
+
+    def tearDown(self):
+        self.redis.flushdb()
+        store._client = None
+        alerts._known.clear()
+
+    def pairs(self, weather_pk=7):
+        return [(flight, weather_pk) for flight in self.flights]
+
+    def test_pairs_are_alerted_once(self):
+        self.assertEqual(alerts.unalerted(self.pairs()), self.pairs())
+        self.assertEqual(alerts.unalerted(self.pairs()), [])
+        self.assertEqual(alerts.unalerted(self.pairs(8)), self.pairs(8))
+
+    def test_alerted_pairs_are_shared_through_redis(self):
+        alerts.unalerted(self.pairs()[:1])
+        alerts._known.clear()
+        self.assertEqual(alerts.unalerted(self.pairs()), self.pairs()[1:])
+        self.assertGreater(self.redis.ttl(alerts.ALERTED_KEY.format(weather=7)), 0)
+
+    def test_known_pairs_skip_redis(self):
+        alerts.unalerted(self.pairs())
+        self.redis.flushdb()
+        self.assertEqual(alerts.unalerted(self.pairs()), [])
+
+    def test_deleted_weather_alerts_again(self):
+        alerts.unalerted(self.pairs())
+        alerts.unalerted(self.pairs(8))
+        alerts.weather_deleted(Weather(pk=7))
+        self.assertEqual(alerts.unalerted(self.pairs()), self.pairs())
+        self.assertEqual(alerts.unalerted(self.pairs(8)), [])
+
+
+@override_settings(REDIS_URL='redis://localhost:6379/15')
+class MoveCoalescingTest(SimpleTestCase):
+
+    channel = 'websocket.send!test'
+
+    def setUp(self):
+        store._client = None
+        self.redis = store.get_redis()
+        self.redis.flushdb()
+
+    def tearDown(self):
+        self.redis.flushdb()
+        store._client = None
+
+    def test_only_the_latest_move_is_taken(self):
+        for zoom in (3, 4, 5):
+            sync.queue_move(self.channel, [0, 0, 1, 1], zoom)
+        self.assertEqual(scheduler.pending(), 3)
+        self.assertIsNone(sync.take_move(self.channel, 1))
+        self.assertIsNone(sync.take_move(self.channel, 2))
+        self.assertEqual(sync.take_move(self.channel, 3), {'bounds': [0, 0, 1, 1], 'zoom': 5, 'compact': False})
+
+    def test_no_move_after_forget(self):
+        sync.queue_move(self.channel, [0, 0, 1, 1], 5, compact=True)
+        sync.forget(self.channel)
+        self.assertIsNone(sync.take_move(self.channel, 1))
+
+    @mock.patch('app.sync.Channel')
+    def test_sync_records_clustered_sessions(self, channel):
+        sync.sync(self.channel, None, 2)
+        self.assertTrue(self.redis.sismember(sync.CLUSTERED_KEY, self.channel))
+        self.assertEqual(self.redis.get(sync.DETAIL_KEY.format(channel=self.channel)), b'overview')
+        message = channel.return_value.send.call_args[0][0]
+        self.assertEqual(json.loads(message['text'])['stream'], 'flight.cluster')
+
+    @mock.patch('app.sync.Channel')
+    def test_superseded_sync_is_abandoned(self, channel):
+        def newer_move(redis, channel, channel_name, bounds, detail, previous, check):
+            redis.incr(sync.SEQ_KEY.format(channel=channel_name))
+            check()
+
+        with mock.patch('app.sync.sync_streams', side_effect=newer_move):
+            sync.sync(self.channel, None, 2)
+        # The newer sync sends everything again
+        self.assertIsNone(self.redis.get(sync.DETAIL_KEY.format(channel=self.channel)))
+        self.assertFalse(self.redis.sismember(sync.CLUSTERED_KEY, self.channel))
+        channel.return_value.send.assert_not_called()
@@ -0,0 +1,229 @@
+"""
+Redis-backed index of map session viewports.
+
+Each session is registered in the cells of a coarse longitude/latitude grid
+that its bounds cover. Small viewports use fine cells and large ones use
+coarser levels, so a session never occupies more than MAX_CELLS cells. A
+lookup unions the cells covering a geometry at every level and then checks
+the exact bounds of the candidates, without touching the database.
+
+Sessions using the JSON format are also added to a channel Group per cell
+and detail level, so a point update is one group send per occupied tile
+and detail rather than one send per session. The size of every group is
+kept in Redis so empty groups are skipped; membership and sizes change
+together in one script, and the reaper rebuilds the sizes from the
+memberships in case they drift. A tile can reach well past the
+viewport at the 10 and 60 degree levels, so group sends are not checked
+against the exact bounds; the map drops flights outside its bounds. Compact
+sessions need per-session state and are indexed separately instead.
+"""
+from channels import Group
+
+from app import lod
+from app.gis import bounding_box_to_polygon
+from app.spatial import grid_cell, grid_cells
+from app.store import get_redis
+
+# Cell sizes in degrees, finest first
+LEVELS = (1.0, 10.0, 60.0)
+MAX_CELLS = 64
+
+CELL_KEY = 'viewport:cell:{level}:{x}:{y}'
+COMPACT_CELL_KEY = 'viewport:compact:{level}:{x}:{y}'
+SESSION_KEY = 'viewport:session:{channel}'
+BOUNDS_KEY = 'viewport:bounds'
+GROUPS_KEY = 'viewport:groups:{channel}'
+GROUP_SIZES_KEY = 'viewport:group-sizes'
+
+GROUP = 'map-tile-{level}-{x}-{y}-{detail}'
+
+# Replace the groups of a session in KEYS[1] with ARGV, counting them in
+# the group sizes hash KEYS[2]. Returns the groups added and removed.
+SET_GROUPS = """
+local new = {}
+for _, group in ipairs(ARGV) do
+    new[group] = true
+end
+local added, removed = {}, {}
+for _, group in ipairs(redis.call('SMEMBERS', KEYS[1])) do
+    if new[group] then
+        new[group] = nil
+    else
+        table.insert(removed, group)
+        if redis.call('HINCRBY', KEYS[2], group, -1) <= 0 then
+            redis.call('HDEL', KEYS[2], group)
+        end
+    end
+end
+for _, group in ipairs(ARGV) do
+    if new[group] then
+        table.insert(added, group)
+        redis.call('HINCRBY', KEYS[2], group, 1)
+    end
+end
+redis.call('DEL', KEYS[1])
+if #ARGV > 0 then
+    redis.call('SADD', KEYS[1], unpack(ARGV))
+end
+return {added, removed}
+"""
+
+# Recount the group sizes KEYS[2] from the groups of every session in the
+# bounds hash KEYS[1]; ARGV[1] is the prefix of the per-session group sets.
+REBUILD_GROUP_SIZES = """
+local sizes = {}
+for _, channel in ipairs(redis.call('HKEYS', KEYS[1])) do
+    for _, group in ipairs(redis.call('SMEMBERS', ARGV[1] .. channel)) do
+        sizes[group] = (sizes[group] or 0) + 1
+    end
+end
+redis.call('DEL', KEYS[2])
+for group, size in pairs(sizes) do
+    redis.call('HSET', KEYS[2], group, size)
+end
+return redis.call('HLEN', KEYS[2])
+"""
+
+_scripts = {}
+
+
+def script(source):
+    if source not in _scripts:
+        _scripts[source] = get_redis().register_script(source)
+    return _scripts[source]
+
+
+def cell_keys(extent, levels=LEVELS, key=CELL_KEY):
+    return [key.format(level=level, x=x, y=y) for level in levels for x, y in grid_cells(extent, level)]
+
+
+def group_names(extent, level, detail):
+    return [GROUP.format(level=level, x=x, y=y, detail=detail) for x, y in grid_cells(extent, level)]
+
+
+def level_for(extent):
+    """
+    The finest level at which extent covers no more than MAX_CELLS cells.
+    """
+    for level in LEVELS:
+        if len(grid_cells(extent, level)) <= MAX_CELLS:
+            return level
+    return LEVELS[-1]
+
+
+def register(channel, bounds, zoom=None, compact=False):
+    """
+    Index the viewport of the session on channel, replacing any previous one.
+    """
+    redis = get_redis()
+    session_key = SESSION_KEY.format(channel=channel)
+    level = level_for(bounds.extent)
+    old_keys = redis.smembers(session_key)
+    new_keys = cell_keys(bounds.extent, levels=(level,))
+    if compact:
+        new_keys += cell_keys(bounds.extent, levels=(level,), key=COMPACT_CELL_KEY)
+        groups = []
+    else:
+        groups = group_names(bounds.extent, level, lod.detail(zoom))
+
+    pipe = redis.pipeline()
+    for key in old_keys:
+        pipe.srem(key, channel)
+    pipe.delete(session_key)
+    for key in new_keys:
+        pipe.sadd(key, channel)
+    pipe.sadd(session_key, *new_keys)
+    values = bounds.extent + ('' if zoom is None else zoom, int(compact))
+    pipe.hset(BOUNDS_KEY, channel, ','.join(str(c) for c in values))
+    pipe.execute()
+
+    set_groups(channel, groups)
+
+
+def set_groups(channel, groups):
+    """
+    Move the session on channel into exactly the given tile groups.
+    """
+    added, removed = script(SET_GROUPS)(keys=[GROUPS_KEY.format(channel=channel), GROUP_SIZES_KEY], args=groups)
+    for group in removed:
+        Group(group.decode('utf-8')).discard(channel)
+    for group in added:
+        Group(group.decode('utf-8')).add(channel)
+
+
+def rebuild_group_sizes():
+    """
+    Recount the size of every tile group from the session memberships.
+    Returns the number of non-empty groups.
+    """
+    return script(REBUILD_GROUP_SIZES)(keys=[BOUNDS_KEY, GROUP_SIZES_KEY], args=[GROUPS_KEY.format(channel='')])
+
+
+def unregister(channel):
+    redis = get_redis()
+    session_key = SESSION_KEY.format(channel=channel)
+    pipe = redis.pipeline()
+    for key in redis.smembers(session_key):
+        pipe.srem(key, channel)
+    pipe.delete(session_key)
+    pipe.hdel(BOUNDS_KEY, channel)
+    pipe.execute()
+
+    set_groups(channel, [])
+
+
+def groups_for_point(point):
+    """
+    (group, detail) of the non-empty tile groups containing point.
+    """
+    names = [
+        (GROUP.format(level=level, x=x, y=y, detail=detail), detail)
+        for level in LEVELS
+        for x, y in (grid_cell(point.x, point.y, level),)
+        for detail in lod.NAMES
+    ]
+    sizes = get_redis().hmget(GROUP_SIZES_KEY, [name for name, _ in names])
+    return [(name, detail) for (name, detail), size in zip(names, sizes) if size is not None and int(size) > 0]
+
+
+def sessions_for_geometry(geometry, compact_only=False):
+    """
+    (channel, zoom, compact) of the sessions whose viewport intersects
+    geometry, or of the compact ones only.
+    """
+    redis = get_redis()
+    keys = cell_keys(geometry.extent, key=COMPACT_CELL_KEY if compact_only else CELL_KEY)
+    candidates = [c.decode('utf-8') for c in redis.sunion(keys)]
+    if not candidates:
+        return []
+
+    sessions = []
+    for channel, value in zip(candidates, redis.hmget(BOUNDS_KEY, candidates)):
+        if value is None:
+            continue
+        bbox, zoom, compact = parse_viewport(value)
+        if bounding_box_to_polygon(bbox).intersects(geometry):
+            sessions.append((channel, zoom, compact))
+    return sessions
+
+
+def parse_viewport(value):
+    values = value.decode('utf-8').split(',')
+    return [float(c) for c in values[:4]], int(values[4]) if values[4] else None, values[5:] == ['1']
+
+
+def viewports(channels):
+    """
+    {channel: (bbox, zoom)} of the registered sessions among channels.
+    """
+    if not channels:
+        return {}
+    values = get_redis().hmget(BOUNDS_KEY, channels)
+    return {channel: parse_viewport(value)[:2] for channel, value in zip(channels, values) if value is not None}
+
+
+def channels_for_geometry(geometry):
+    """
+    Channels of the sessions whose viewport intersects geometry.
+    """
+    return [channel for channel, zoom, compact in sessions_for_geometry(geometry)]
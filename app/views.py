@@ -1,6 +1,12 @@
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
+from django.http import JsonResponse
 from django.shortcuts import render
 
+from app import lanes
+from app import metrics as app_metrics
+from app import scheduler
+
 
 def index(request):
     return render(request, "app/index.html", {})
@@ -9,3 +15,11 @@ def index(request):
 @login_required
 def flightplan(request):
     return render(request, "app/flightplan.html", {})
+
+
+@staff_member_required
+def metrics(request):
+    snapshot = app_metrics.snapshot()
+    snapshot['scheduler_pending'] = scheduler.pending()
+    snapshot['lanes'] = lanes.report(snapshot)
+    return JsonResponse(snapshot)
@@ -0,0 +1,136 @@
+"""
+Background delivery of outbound POSTs.
+
+Signal handlers only queue payloads. A daemon thread per process drains the
+queue in batches over a pooled keep-alive session, retrying failed posts a
+bounded number of times. When the queue is full new payloads are dropped
+and counted rather than blocking the caller. The backlog left behind each
+batch is recorded as the webhooks.backlog histogram.
+"""
+import atexit
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from app import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Dispatcher(object):
+
+    def __init__(self, queue_size=10000, batch_size=100, timeout=5, retries=3, backoff=0.5, batch_posts=False):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.batch_posts = batch_posts
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=4))
+        self.session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=4))
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def post(self, url, text):
+        """
+        Queue text to be posted to url as the 'data' form field.
+        """
+        self.start()
+        try:
+            self.queue.put_nowait((url, text))
+            self.count('queued')
+        except queue.Full:
+            self.count('dropped')
+
+    def start(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self.run, name='webhooks', daemon=True)
+                    self._thread.start()
+
+    def count(self, name):
+        metrics.incr('webhooks.' + name)
+
+    def next_batch(self, timeout=None):
+        batch = [self.queue.get(timeout=timeout)]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def send(self, url, data):
+        for attempt in range(self.retries + 1):
+            try:
+                with metrics.timed('webhooks.post'):
+                    response = self.session.post(url, data={'data': data}, timeout=self.timeout)
+                response.raise_for_status()
+                self.count('sent')
+                return True
+            except requests.RequestException as e:
+                if attempt == self.retries:
+                    logger.warning('Giving up on POST to %s: %s', url, e)
+                    self.count('failed')
+                    return False
+                self.count('retried')
+                time.sleep(self.backoff * 2 ** attempt)
+
+    def deliver(self, batch):
+        by_url = OrderedDict()
+        for url, text in batch:
+            by_url.setdefault(url, []).append(text)
+
+        for url, texts in by_url.items():
+            if self.batch_posts:
+                self.send(url, '[' + ','.join(texts) + ']')
+            else:
+                for text in texts:
+                    self.send(url, text)
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            # Payloads still waiting behind this batch
+            metrics.observe_count('webhooks.backlog', self.queue.qsize())
+            try:
+                self.deliver(batch)
+            except Exception:
+                logger.exception('Webhook delivery failed')
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def flush(self, timeout=5):
+        """
+        Deliver whatever is still queued, for use on shutdown.
+        """
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                batch = self.next_batch(timeout=0)
+            except queue.Empty:
+                return
+            self.deliver(batch)
+
+
+dispatcher = Dispatcher(
+    queue_size=settings.WEBHOOK_QUEUE_SIZE,
+    batch_size=settings.WEBHOOK_BATCH_SIZE,
+    timeout=settings.WEBHOOK_TIMEOUT,
+    retries=settings.WEBHOOK_RETRIES,
+    batch_posts=settings.WEBHOOK_BATCH_POSTS,
+)
+atexit.register(dispatcher.flush)
+
+
+def post(url, text):
+    dispatcher.post(url, text)
@@ -0,0 +1,93 @@
+"""
+Compact binary wire format for the /app/map stream.
+
+Sessions that opt in with ``format: compact`` on map.move still get every
+feature as GeoJSON the first time they see it, but subsequent flight
+position updates are sent as fixed binary records, batched into one
+websocket frame per session per tick.
+
+A frame is a header of (kind: uint8, count: uint16) followed by count
+records of (ident length: uint8, ident: ASCII, longitude: float32,
+latitude: float32, heading: int16, status: uint8), all little-endian.
+"""
+import struct
+from collections import defaultdict
+
+from channels import Channel
+
+from app import lod, metrics
+from app.models import FlightStatus
+from app.store import get_redis
+from app.sync import SENT_KEY
+
+POSITIONS = 1
+
+HEADER = struct.Struct('<BH')
+RECORD = struct.Struct('<ffhB')
+
+STATUSES = [status.value for status in FlightStatus]
+
+MAX_RECORDS = 1000
+
+STREAM = 'flight.info'
+
+
+def record(flight):
+    ident = flight.ident.encode('ascii')
+    x, y = flight.location.coords
+    heading = int(round(flight.heading or 0)) % 360
+    return struct.pack('<B', len(ident)) + ident + RECORD.pack(x, y, heading, STATUSES.index(flight.status))
+
+
+def frames(records):
+    for i in range(0, len(records), MAX_RECORDS):
+        chunk = records[i:i + MAX_RECORDS]
+        yield HEADER.pack(POSITIONS, len(chunk)) + b''.join(chunk)
+
+
+class FrameBuffer(object):
+    """
+    Collects position records per channel and sends them as few frames.
+    """
+
+    def __init__(self):
+        self.records = defaultdict(list)
+
+    def add(self, channel, data):
+        self.records[channel].append(data)
+
+    def flush(self):
+        for channel, records in self.records.items():
+            for frame in frames(records):
+                Channel(channel).send({'bytes': frame})
+                metrics.incr('messages.map.compact')
+            metrics.observe_count('wire.records_per_frame', len(records))
+        self.records.clear()
+
+
+def send_positions(flight, sessions, message, buffer=None):
+    """
+    Send flight to compact sessions [(channel, zoom)]: message(detail) to
+    the ones seeing it for the first time, a position record to the rest.
+    """
+    # Clustered sessions get flight counts instead
+    sessions = [(channel, zoom) for channel, zoom in sessions if not lod.is_clustered(lod.detail(zoom))]
+    if not sessions:
+        return
+
+    pipe = get_redis().pipeline(transaction=False)
+    for channel, zoom in sessions:
+        pipe.sadd(SENT_KEY.format(channel=channel, stream=STREAM), flight.ident)
+    first_sight = pipe.execute()
+
+    data = None
+    for (channel, zoom), new in zip(sessions, first_sight):
+        if new:
+            Channel(channel).send(message(lod.detail(zoom)))
+            continue
+        if data is None:
+            data = record(flight)
+        if buffer is None:
+            Channel(channel).send({'bytes': HEADER.pack(POSITIONS, 1) + data})
+        else:
+            buffer.add(channel, data)
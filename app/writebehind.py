@@ -0,0 +1,309 @@
+"""
+Write-behind persistence of simulated positions.
+
+A tick no longer writes the database itself. It buffers the latest tick
+columns of each flight in a Redis hash and its position reports in a Redis
+list, and makes sure a ``flightplan.persist`` message is scheduled. That
+message drains both buffers and writes them with one bulk UPDATE per batch
+of flights and one bulk INSERT of reports. However many ticks run in
+between, the database sees one write per flight and interval.
+
+Buffered flight state is the newest state, so anything that reads flights
+to move, change or save them overlays it with ``overlay()`` first. A flush moves the
+buffers to flushing keys, which overlay() reads too, and only deletes them
+once the database transaction has committed. Until then a tick reading the
+rows the flush has not yet written still sees the buffered state. Should
+the write fail, the entries stay in the flushing keys and are merged with
+anything buffered since by the next flush. Flushes never overlap.
+
+A flush locks the rows it writes and then reads the flushing keys again, so
+it skips state dropped by discard() or forget() while it was starting, and
+a full save made meanwhile waits for it and wins. Reports of flights that
+no longer exist are skipped.
+"""
+import json
+import time
+
+from dateutil.parser import parse
+from django.conf import settings
+from django.contrib.gis.geos import LineString, Point
+from django.db import transaction
+
+from app import metrics
+from app.models import Flight, PositionReport
+from app.scheduler import schedule
+from app.store import get_redis
+
+FLUSH_CHANNEL = 'flightplan.persist'
+FLIGHTS_KEY = 'writebehind:flights'
+REPORTS_KEY = 'writebehind:reports'
+FLUSHING_FLIGHTS_KEY = 'writebehind:flushing:flights'
+FLUSHING_REPORTS_KEY = 'writebehind:flushing:reports'
+FLUSH_LOCK = 'writebehind:scheduled'
+FLUSHING_LOCK = 'writebehind:flushing'
+
+# Seconds a flush may hold FLUSHING_LOCK
+FLUSH_TIMEOUT = 60
+
+# Move the buffers KEYS[1] and KEYS[2] to the flushing keys KEYS[3] and
+# KEYS[4], merging them into what a failed flush left there, and return
+# the contents of the flushing keys.
+TAKE = """
+if redis.call('EXISTS', KEYS[3]) == 0 and redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('RENAME', KEYS[1], KEYS[3])
+else
+    local flights = redis.call('HGETALL', KEYS[1])
+    for i = 1, #flights, 1000 do
+        redis.call('HMSET', KEYS[3], unpack(flights, i, math.min(i + 999, #flights)))
+    end
+    redis.call('DEL', KEYS[1])
+end
+if redis.call('EXISTS', KEYS[4]) == 0 and redis.call('EXISTS', KEYS[2]) == 1 then
+    redis.call('RENAME', KEYS[2], KEYS[4])
+else
+    local reports = redis.call('LRANGE', KEYS[2], 0, -1)
+    for i = 1, #reports, 1000 do
+        redis.call('RPUSH', KEYS[4], unpack(reports, i, math.min(i + 999, #reports)))
+    end
+    redis.call('DEL', KEYS[2])
+end
+return {redis.call('HGETALL', KEYS[3]), redis.call('LRANGE', KEYS[4], 0, -1)}
+"""
+
+# Remove the flights ARGV from the hashes KEYS[1] and KEYS[2] and their
+# reports from the lists KEYS[3] and KEYS[4].
+FORGET = """
+for _, key in ipairs({KEYS[1], KEYS[2]}) do
+    redis.call('HDEL', key, unpack(ARGV))
+end
+local forgotten = {}
+for _, pk in ipairs(ARGV) do
+    forgotten[pk] = true
+end
+for _, key in ipairs({KEYS[3], KEYS[4]}) do
+    local reports = redis.call('LRANGE', key, 0, -1)
+    local kept = {}
+    for _, report in ipairs(reports) do
+        if not forgotten[tostring(cjson.decode(report)['flight'])] then
+            kept[#kept + 1] = report
+        end
+    end
+    if #kept < #reports then
+        redis.call('DEL', key)
+        for i = 1, #kept, 1000 do
+            redis.call('RPUSH', key, unpack(kept, i, math.min(i + 999, #kept)))
+        end
+    end
+end
+"""
+
+_take = None
+_forget = None
+
+# Columns buffered for each flight, in the order they are serialized
+FIELDS = ['status', 'time', 'location', 'heading', 'remaining_path', 'facility', 'current_step']
+
+
+def flight_values(flight):
+    return {
+        'status': flight.status,
+        'time': flight.time.isoformat(),
+        'location': flight.location.coords,
+        'heading': flight.heading,
+        'remaining_path': flight.remaining_path.coords if flight.remaining_path else None,
+        'facility': flight.facility_id,
+        'current_step': flight.current_step,
+    }
+
+
+def apply_values(flight, values):
+    flight.status = values['status']
+    flight.time = parse(values['time'])
+    flight.location = Point(values['location'], srid=4326)
+    # Buffered positions have been reported
+    flight._reported_location = flight.location
+    flight.heading = values['heading']
+    flight.remaining_path = LineString(values['remaining_path'], srid=4326) if values['remaining_path'] else None
+    flight.facility_id = values['facility']
+    flight.current_step = values['current_step']
+    return flight
+
+
+def report_values(report):
+    return {
+        'flight': report.flight_id,
+        'time': report.time.isoformat(),
+        'location': report.location.coords,
+        'heading': report.heading,
+    }
+
+
+def ensure_flush():
+    """
+    Schedule a flush unless one is already scheduled.
+    """
+    interval = settings.WRITE_BEHIND_INTERVAL
+    if get_redis().set(FLUSH_LOCK, 1, nx=True, ex=max(int(interval * 10), 10)):
+        schedule(FLUSH_CHANNEL, {}, time.time() + interval)
+
+
+def buffer(flights):
+    """
+    Queue the tick columns of flights, and a position report of each one
+    that has moved.
+    """
+    if not flights:
+        return
+    reports = [json.dumps(report_values(flight.position_report())) for flight in flights if flight.moved]
+    pipe = get_redis().pipeline(transaction=False)
+    pipe.hmset(FLIGHTS_KEY, {flight.pk: json.dumps(flight_values(flight)) for flight in flights})
+    if reports:
+        pipe.rpush(REPORTS_KEY, *reports)
+    pipe.execute()
+    ensure_flush()
+
+
+def pending(pks):
+    """
+    Buffered values not yet written for the flights in pks, by pk.
+    """
+    if not pks:
+        return {}
+    pipe = get_redis().pipeline(transaction=False)
+    pipe.hmget(FLIGHTS_KEY, pks)
+    pipe.hmget(FLUSHING_FLIGHTS_KEY, pks)
+    buffered, flushing = pipe.execute()
+    values = [b if b is not None else f for b, f in zip(buffered, flushing)]
+    return {pk: json.loads(v.decode('utf-8')) for pk, v in zip(pks, values) if v is not None}
+
+
+def overlay(flights):
+    """
+    Bring flights loaded from the database up to their buffered state.
+    """
+    buffered = pending([flight.pk for flight in flights])
+    for flight in flights:
+        if flight.pk in buffered:
+            apply_values(flight, buffered[flight.pk])
+    return flights
+
+
+def discard(pks):
+    """
+    Drop buffered state for flights that have just been saved in full,
+    after being overlaid.
+    """
+    if pks:
+        pipe = get_redis().pipeline(transaction=False)
+        pipe.hdel(FLIGHTS_KEY, *pks)
+        pipe.hdel(FLUSHING_FLIGHTS_KEY, *pks)
+        pipe.execute()
+
+
+def forget(pks):
+    """
+    Drop buffered state and position reports of flights that have been
+    deleted or reset.
+    """
+    global _forget
+    if not pks:
+        return
+    if _forget is None:
+        _forget = get_redis().register_script(FORGET)
+    _forget(keys=[FLIGHTS_KEY, FLUSHING_FLIGHTS_KEY, REPORTS_KEY, FLUSHING_REPORTS_KEY], args=pks)
+
+
+def take():
+    """
+    Move the buffers to the flushing keys and return their contents.
+    """
+    global _take
+    if _take is None:
+        _take = get_redis().register_script(TAKE)
+    flights, reports = _take(keys=[FLIGHTS_KEY, REPORTS_KEY, FLUSHING_FLIGHTS_KEY, FLUSHING_REPORTS_KEY])
+    return dict(zip(flights[::2], flights[1::2])), reports
+
+
+def flushing():
+    """
+    The decoded contents of the flushing keys: values by flight pk, and
+    report values.
+    """
+    pipe = get_redis().pipeline(transaction=False)
+    pipe.hgetall(FLUSHING_FLIGHTS_KEY)
+    pipe.lrange(FLUSHING_REPORTS_KEY, 0, -1)
+    flights, reports = pipe.execute()
+    return (
+        {int(pk): json.loads(values.decode('utf-8')) for pk, values in flights.items()},
+        [json.loads(report.decode('utf-8')) for report in reports],
+    )
+
+
+def lock(pks):
+    """
+    Lock the rows of the flights in pks until the transaction ends, waiting
+    for a flush writing them. Returns the pks that exist.
+    """
+    return set(Flight.objects.select_for_update().filter(pk__in=pks).order_by('pk').values_list('pk', flat=True))
+
+
+def write(pks):
+    """
+    Write the flushing entries of those flights in pks that still exist,
+    locking their rows first. Returns the number of flights and reports
+    written.
+    """
+    existing = lock(pks)
+
+    # Entries discarded or forgotten before the rows were locked are gone
+    flights, reports = flushing()
+    flights = {pk: values for pk, values in flights.items() if pk in existing}
+    reports = [values for values in reports if values['flight'] in existing]
+
+    Flight.objects.bulk_update([apply_values(Flight(pk=pk), values) for pk, values in flights.items()], FIELDS)
+    PositionReport.objects.bulk_create([
+        PositionReport(
+            flight_id=values['flight'],
+            time=parse(values['time']),
+            location=Point(values['location'], srid=4326),
+            heading=values['heading'],
+        )
+        for values in reports
+    ], batch_size=1000)
+    return len(flights), len(reports)
+
+
+def flush():
+    """
+    Write everything buffered to the database. Returns the number of flights
+    and reports written.
+    """
+    redis = get_redis()
+    redis.delete(FLUSH_LOCK)
+    if not redis.set(FLUSHING_LOCK, 1, nx=True, ex=FLUSH_TIMEOUT):
+        # Another flush is still writing; run again after it
+        ensure_flush()
+        return 0, 0
+
+    try:
+        flights, reports = take()
+        if not (flights or reports):
+            return 0, 0
+
+        pks = {int(pk) for pk in flights}
+        pks.update(json.loads(report.decode('utf-8'))['flight'] for report in reports)
+        try:
+            with metrics.timed('writebehind.flush'), transaction.atomic():
+                written = write(pks)
+        except Exception:
+            # The entries stay in the flushing keys for the next flush
+            ensure_flush()
+            raise
+
+        redis.delete(FLUSHING_FLIGHTS_KEY, FLUSHING_REPORTS_KEY)
+    finally:
+        redis.delete(FLUSHING_LOCK)
+
+    metrics.observe_count('writebehind.flights', written[0])
+    metrics.observe_count('writebehind.reports', written[1])
+    return written
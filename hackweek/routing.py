@@ -1,15 +1,21 @@
-from channels import route, route_class
+from channels import route_class
 
 from app.consumers import DefaultDemultiplexer, flightplan, map
+from app.lanes import route
 
 channel_routing = [
 
     route_class(flightplan.Demultiplexer, path=r'^/flightplan'),
     route('flightplan.state', flightplan.state),
-    route('flightplan.simulate', flightplan.simulate),
+    route('flightplan.batch', flightplan.batch),
+    route('flightplan.tick', flightplan.tick),
+    route('flightplan.persist', flightplan.persist),
 
     route_class(map.Demultiplexer, path=r'^/app/map'),
     route("map.move", map.move),
+    route("map.sync", map.sync),
+    route("map.heartbeat", map.heartbeat),
+    route("map.reap", map.reap),
 
     route_class(DefaultDemultiplexer),
 ]
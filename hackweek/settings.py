@@ -52,6 +52,8 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = 'hackweek.urls'
 
+REDIS_URL = 'redis://localhost:6379/0'
+
 CHANNEL_LAYERS = {
     "default": {
         "BACKEND": "asgi_redis.RedisChannelLayer",
@@ -144,3 +146,39 @@ WEATHER_ALERT_POST_URL = 'http://{ip}:{port}/data/alert'.format(ip=POST_IP, port
 SERVER = DESKTOP
 SERVER_PORT = 8000
 BASE_URL = 'http://{ip}:{port}/'.format(ip=SERVER, port=SERVER_PORT)
+
+# Simulation
+CIRCLE_ON_ARRIVAL = True
+
+# Seconds between write-behind flushes of simulated positions
+WRITE_BEHIND_INTERVAL = 0.25
+
+# Outbound POST delivery
+WEBHOOK_QUEUE_SIZE = 10000
+WEBHOOK_BATCH_SIZE = 100
+WEBHOOK_TIMEOUT = 5
+WEBHOOK_RETRIES = 3
+WEBHOOK_BATCH_POSTS = False
+
+# Seconds to wait for further map.move events before syncing a viewport
+MAP_MOVE_DEBOUNCE = 0.2
+
+# Minimum seconds between cluster snapshots pushed to a zoomed-out map
+MAP_CLUSTER_REFRESH = 5
+
+# Map session liveness, in seconds
+MAP_SESSION_TTL = 90
+MAP_REAP_INTERVAL = 30
+
+# Worker lanes started by runworkers, highest priority first. Each lane has
+# its own workers pinned to runworker channel patterns, keeps at least its
+# reserved workers, and gets spare capacity in priority order. Channels no
+# lane names are served by a catch-all default lane.
+WORKER_LANES = [
+    {'name': 'interactive', 'channels': ['websocket.*', 'map.*'], 'priority': 0, 'reserved': 2},
+    {'name': 'ingest', 'channels': ['flightplan.state', 'flightplan.batch'], 'priority': 1, 'reserved': 1},
+    {'name': 'simulation', 'channels': ['flightplan.tick', 'flightplan.persist'], 'priority': 2, 'reserved': 1},
+]
+WORKERS_PER_CPU = 2
+# Backlog that adds one worker to a pool
+WORKER_MESSAGES_PER_WORKER = 50